@@ -0,0 +1,72 @@
+import re
+from functools import lru_cache
+
+from porterstemmer import Stemmer
+
+
+def whitespace_tokenizer(text):
+    return text.split()
+
+
+def alphanumeric_tokenizer(text):
+    return filter(None, re.split(r'[^a-zA-Z\d:]', text))
+
+
+class StopWords(object):
+
+    def __init__(self, common_words_file="common_words"):
+        self._common_words = set()
+        with open(common_words_file) as my_file:
+            for line in my_file:
+                self._common_words.add(line[:-1])
+
+    def is_common_word(self, word):
+        return word in self._common_words
+
+
+class MemoizedStemmer(object):
+    """A Porter stemmer with a bounded word -> stem cache.
+
+    Token frequencies follow Zipf's law: most calls to the stemmer are repeated, hence the cache.
+    """
+
+    def __init__(self, capacity=2**17):
+        self._stem = lru_cache(maxsize=capacity)(Stemmer())
+
+    def __call__(self, word):
+        return self._stem(word)
+
+    def get_cache_info(self):
+        """Return the (hits, misses) counters of the cache."""
+        info = self._stem.cache_info()
+        return info.hits, info.misses
+
+
+shared_stemmer = MemoizedStemmer()
+
+
+class Analyzer(object):
+    """Turn a raw text into a list of terms.
+
+    The pipeline is: tokenizer -> lowercase -> stop-word filter -> stemmer. The tokenizer and the stemmer can be
+    replaced, and the stop-word filter and the stemmer can be disabled with None.
+    """
+
+    def __init__(self, tokenizer=whitespace_tokenizer, lowercase=True, common_words_file="common_words",
+                 stemmer=shared_stemmer):
+        self.tokenizer = tokenizer
+        self.lowercase = lowercase
+        self.stop_words = None if common_words_file is None else StopWords(common_words_file)
+        self.stemmer = stemmer
+
+    def analyze(self, text):
+        if self.lowercase:
+            text = text.lower()
+        tokens = self.tokenizer(text)
+        if self.stop_words is not None:
+            is_common_word = self.stop_words.is_common_word
+            tokens = [token for token in tokens if not is_common_word(token)]
+        if self.stemmer is not None:
+            stemmer = self.stemmer
+            return [stemmer(token) for token in tokens]
+        return list(tokens)
@@ -0,0 +1,74 @@
+"""Compare the size and the decoding speed of refined posting lists with the fixed-size and the compressed codecs.
+
+The fixed-size codec is the previous format of the index: a term id followed by one 'if' struct (8 bytes) per posting.
+Document frequencies follow Zipf's law, as in a real collection.
+Run it from the root of the project with: python3 -m benchmarks.codec
+"""
+import argparse
+import random
+import struct
+import time
+
+import numpy as np
+
+from utils import term_index_to_bin, bin_to_term_index, decode_posting_list, REFINED_POSTING_DTYPE
+
+
+def _fixed_size_term_index_to_bin(term_index):
+    result = struct.pack('i', term_index[0])
+    for posting in term_index[1]:
+        result += struct.pack('if', *posting)
+    return result
+
+
+def _fixed_size_bin_to_term_index(raw_bin):
+    return struct.unpack_from('i', raw_bin)[0], list(struct.iter_unpack('if', raw_bin[4:]))
+
+
+def _fixed_size_decode_posting_list(raw_bin):
+    posting_list = np.frombuffer(raw_bin, dtype=REFINED_POSTING_DTYPE, offset=4)
+    return struct.unpack_from('i', raw_bin)[0], posting_list['doc_id'], posting_list['weight']
+
+
+def _make_posting_lists(docs_amount, vocabulary_size):
+    rng = random.Random(0)
+    posting_lists = list()
+    for rank in range(1, vocabulary_size + 1):
+        df = max(1, int(0.7 * docs_amount / rank))
+        doc_ids = sorted(rng.sample(range(1, docs_amount + 1), df))
+        posting_lists.append((rank, [(doc_id, rng.random()) for doc_id in doc_ids]))
+    return posting_lists
+
+
+def _measure(binaries, decode, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        for raw_bin in binaries:
+            decode(raw_bin)
+    return (time.time() - start) / repeat
+
+
+def benchmark(docs_amount, vocabulary_size, repeat):
+    posting_lists = _make_posting_lists(docs_amount, vocabulary_size)
+    print("%i posting lists, %i postings" % (len(posting_lists), sum([len(pl[1]) for pl in posting_lists])))
+    print("| Codec | Size (MB) | Decode to tuples (s) | Decode to arrays (s) |")
+    print("| --- | --- | --- | --- |")
+    codecs = [("fixed-size", _fixed_size_term_index_to_bin, _fixed_size_bin_to_term_index,
+               _fixed_size_decode_posting_list),
+              ("compressed", lambda term_index: term_index_to_bin(term_index, refined=True),
+               lambda raw_bin: bin_to_term_index(raw_bin, refined=True),
+               lambda raw_bin: decode_posting_list(raw_bin, refined=True))]
+    for name, encode, decode_to_tuples, decode_to_arrays in codecs:
+        binaries = [encode(term_index) for term_index in posting_lists]
+        print("| %s | %.1f | %.3f | %.3f |" % (name, sum([len(raw_bin) for raw_bin in binaries]) / 2**20,
+                                              _measure(binaries, decode_to_tuples, repeat),
+                                              _measure(binaries, decode_to_arrays, repeat)))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-d', '--documents', default=100000, type=int, help="the amount of documents")
+    arg_parser.add_argument('-t', '--terms', default=20000, type=int, help="the size of the vocabulary")
+    arg_parser.add_argument('-r', '--repeat', default=3, type=int, help="the amount of decoding rounds to average")
+    args = arg_parser.parse_args()
+    benchmark(args.documents, args.terms, args.repeat)
@@ -0,0 +1,92 @@
+"""Measure the duration of the Merge step as the amount of block indexes grows, with the heap of BlockIndexMerger and
+with the former selection of the next term, which peeked every read queue.
+
+The total amount of documents and postings is fixed: only the amount of blocks they are split into varies.
+Run it from the root of the project with: python3 -m benchmarks.merge
+"""
+import argparse
+import random
+import time
+from collections import OrderedDict
+
+from collection import IDStorer
+from index_construction.merge import BlockIndexMerger
+from index_construction.parse import write_block_index
+from index_construction.weights import WeightFactory
+
+
+class _BenchmarkCollection(object):
+
+    def __init__(self, collection_path):
+        self.collection_path = collection_path
+        self.id_storer = IDStorer()
+
+
+class _PeekingMerger(BlockIndexMerger):
+    """The Merge step before the heap: the next run is found by peeking every read queue, in O(k) for k blocks, and
+    concatenated to the runs of the same term already popped."""
+
+    def _pop_lexically_first(self):
+        term, posting_list = None, None
+        while True:
+            reader = None
+            for candidate in self._readers:
+                if candidate.peek() is not None and (reader is None or candidate.peek()[0] < reader.peek()[0]):
+                    reader = candidate
+            if reader is None or (term is not None and reader.peek()[0] != term):
+                break
+            term, run = reader.pop()
+            posting_list = run if posting_list is None else posting_list + run
+        if term is None:
+            return None
+        return self._collection.id_storer.add_term(term), posting_list, None
+
+
+def _write_runs(collection, weighter, blocks_amount, docs_amount, vocabulary_size, doc_length):
+    rng = random.Random(blocks_amount)
+    block_positions = OrderedDict()
+    docs_per_block = docs_amount // blocks_amount
+    for block in range(blocks_amount):
+        term_index = dict()
+        for doc_id in range(block * docs_per_block + 1, (block + 1) * docs_per_block + 1):
+            doc_frequency_dict = dict()
+            for term_id in rng.choices(range(1, vocabulary_size + 1), k=doc_length):
+                doc_frequency_dict[term_id] = doc_frequency_dict.get(term_id, 0) + 1
+            for term_id, freq in doc_frequency_dict.items():
+                term_index.setdefault("term%i" % term_id, list()).append((doc_id, freq))
+        for posting_list in term_index.values():
+            weighter.stats.process_posting_list(posting_list)
+        run_path = "%s/%i" % (collection.collection_path, block)
+        block_positions[run_path] = write_block_index(run_path, term_index)
+    weighter.stats.signal_end_of_merge()
+    return block_positions
+
+
+def _merge(merger_class, blocks_amount, docs_amount, vocabulary_size, doc_length, memory):
+    collection = _BenchmarkCollection("benchmark-merge")
+    weighter = WeightFactory.get_weight_function(0, docs_amount - docs_amount % blocks_amount)
+    block_positions = _write_runs(collection, weighter, blocks_amount, docs_amount, vocabulary_size, doc_length)
+    start = time.time()
+    merger_class(collection, block_positions, weighter, memory * 2**20, verbose=False).merge()
+    return time.time() - start
+
+
+def benchmark(blocks_amounts, docs_amount, vocabulary_size, doc_length, memory):
+    print("| Blocks | Merge with peeks (s) | Merge with heap (s) |")
+    print("| --- | --- | --- |")
+    for blocks_amount in blocks_amounts:
+        durations = [_merge(merger_class, blocks_amount, docs_amount, vocabulary_size, doc_length, memory)
+                     for merger_class in [_PeekingMerger, BlockIndexMerger]]
+        print("| %i | %.1f | %.1f |" % tuple([blocks_amount] + durations))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-b', '--blocks', default=[10, 50, 100, 250, 500], type=int, nargs='+',
+                            help="the amounts of blocks to benchmark")
+    arg_parser.add_argument('-d', '--documents', default=20000, type=int, help="the amount of documents")
+    arg_parser.add_argument('-t', '--terms', default=20000, type=int, help="the size of the vocabulary")
+    arg_parser.add_argument('-l', '--length', default=50, type=int, help="the amount of tokens per document")
+    arg_parser.add_argument('-m', '--memory', default=64, type=int, help="set memory limitations (in MB)")
+    args = arg_parser.parse_args()
+    benchmark(args.blocks, args.documents, args.terms, args.length, args.memory)
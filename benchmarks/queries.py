@@ -0,0 +1,84 @@
+"""Measure the response time of vector queries on a synthetic collection.
+
+Terms are drawn from a Zipf distribution: w1 is found in most documents, like "stanford" in CS276.
+Run it from the root of the project with: python3 -m benchmarks.queries
+"""
+import argparse
+import os
+import random
+import time
+
+from collection import Collection
+from index_construction.main import build_index
+from queries.feedback import Rocchio
+from queries.vector_queries import VectorQueryParser
+
+QUERIES = ["w1", "w1 w2", "w1 w2 w3 w5 w8 w13 w21 w34", "w100 w1000", "w5000"]
+POSITIONAL_QUERIES = ['"w1 w2"', "w1 NEAR/3 w2", '"w2 w3 w5"', '"w100 w1000"', "w100 NEAR/10 w1000"]
+
+
+def _write_collection(collection_path, blocks_amount, docs_amount, vocabulary_size, doc_length):
+    if os.path.exists(collection_path):
+        return
+    rng = random.Random(0)
+    vocabulary = ["w%i" % rank for rank in range(1, vocabulary_size + 1)]
+    frequencies = [1.0 / rank for rank in range(1, vocabulary_size + 1)]
+    for doc in range(docs_amount):
+        block_path = "%s/%i" % (collection_path, doc % blocks_amount)
+        os.makedirs(block_path, exist_ok=True)
+        with open("%s/doc%i" % (block_path, doc), 'w') as doc_file:
+            doc_file.write(" ".join(rng.choices(vocabulary, weights=frequencies, k=doc_length)))
+
+
+def benchmark(docs_amount, vocabulary_size, doc_length, repeat, raw_frequencies=False, feedback_docs=None,
+              positional=False, top_k=None, cache_memory=None, postings_cache_memory=None, pinned_terms=0):
+    collection_path = "benchmark-queries-%i-data" % docs_amount
+    _write_collection(collection_path, 10, docs_amount, vocabulary_size, doc_length)
+    collection = Collection(collection_path, verbose=False)
+    positions = build_index(collection, 1, verbose=False, raw_frequencies=raw_frequencies, positional=positional,
+                            forward=feedback_docs is not None)
+    runner = VectorQueryParser(collection, "indexes/%s.index" % collection.collection_path, positions, verbose=False,
+                               feedback=None if feedback_docs is None else Rocchio(feedback_docs), top_k=top_k,
+                               cache_memory=cache_memory, postings_cache_memory=postings_cache_memory,
+                               pinned_terms=pinned_terms)
+    if cache_memory is None:
+        print("| Query | # documents retrieved | Response time (ms) |")
+        print("| --- | --- | --- |")
+    else:  # the first run of a query misses the cache, the next ones hit it
+        print("| Query | # documents retrieved | Miss (ms) | Hit (ms) |")
+        print("| --- | --- | --- | --- |")
+    for query in QUERIES + (POSITIONAL_QUERIES if positional else list()):
+        durations = list()
+        for _ in range(repeat):
+            start = time.time()
+            results = runner.execute_query(query)
+            durations.append(time.time() - start)
+        if cache_memory is None:
+            print("| %s | %i | %.1f |" % (query, len(results), 1000 * sorted(durations)[len(durations) // 2]))
+        else:
+            hits = sorted(durations[1:])
+            print("| %s | %i | %.1f | %.3f |" % (query, len(results), 1000 * durations[0],
+                                                  1000 * hits[len(hits) // 2]))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser()
+    arg_parser.add_argument('-d', '--documents', default=100000, type=int, help="the amount of documents")
+    arg_parser.add_argument('-t', '--terms', default=20000, type=int, help="the size of the vocabulary")
+    arg_parser.add_argument('-l', '--length', default=30, type=int, help="the amount of tokens per document")
+    arg_parser.add_argument('-r', '--repeat', default=5, type=int, help="the amount of runs per query (median)")
+    arg_parser.add_argument('--raw', action="store_true", help="weight a raw-frequency index at query time")
+    arg_parser.add_argument('-f', '--feedback', default=None, type=int, metavar="DOCS",
+                            help="expand the queries with the vectors of their DOCS top documents")
+    arg_parser.add_argument('-P', '--positional', action="store_true", help="also run phrase and proximity queries")
+    arg_parser.add_argument('-k', '--top', default=None, type=int, help="only retrieve the TOP best documents")
+    arg_parser.add_argument('-C', '--cache', default=None, type=int, metavar="MB",
+                            help="cache the results within MB of memory: the first run of a query is a miss")
+    arg_parser.add_argument('-L', '--postings-cache', default=None, type=int, metavar="MB",
+                            help="cache the decoded posting lists within MB of memory")
+    arg_parser.add_argument('-n', '--pin', default=0, type=int, metavar="TERMS",
+                            help="pin the posting lists of the TERMS most frequent terms in the cache")
+    args = arg_parser.parse_args()
+    benchmark(args.documents, args.terms, args.length, args.repeat, args.raw, args.feedback, args.positional,
+              args.top, None if args.cache is None else args.cache * 2**20,
+              None if args.postings_cache is None else args.postings_cache * 2**20, args.pin)
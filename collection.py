@@ -1,7 +1,13 @@
 import glob
+from os import replace
+from os.path import exists, getmtime
 from threading import Lock
 
-from utils import save_map
+import numpy as np
+
+from doc_store import DocStore, DocMap
+from term_dictionary import TermDictionary
+from utils import make_dirs
 from printer import CollectionPrinter
 
 
@@ -40,22 +46,126 @@ class Collection(object):
         self.collection_path = collection_path
         self.id_storer = IDStorer()
         self.blocks = [Block(path, self.id_storer) for path in glob.glob(collection_path + "/*")]
+        self.live_docs = LiveDocs()
         self.printer.print_build_end_message(len(self.blocks), len(self))
 
     def store_maps(self):
-        save_map(self.id_storer.doc_map, "indexes/" + self.collection_path + "/docmap")
-        save_map(self.id_storer.term_map, "indexes/" + self.collection_path + "/termmap")
+        DocStore.write(self.id_storer.doc_map, "indexes/" + self.collection_path + "/docmap")
+        term_map = self.id_storer.term_map
+        TermDictionary.write(sorted(term_map, key=term_map.get), "indexes/" + self.collection_path + "/termdict")
+        self.live_docs.file_path = "indexes/" + self.collection_path + "/livedocs"
+        self.live_docs.save()
+
+    def delete_documents(self, doc_paths):
+        """Remove documents from the results at once: their postings are dropped by the next compaction.
+
+        The paths are also logged in indexes/<collection>/deleted_docs, so that the next full build skips them.
+        :return: the amount of documents deleted
+        """
+        doc_ids = {doc_path: doc_id for doc_id, doc_path in self.id_storer.doc_map.items()}
+        deleted_docs = [doc_path for doc_path in doc_paths if doc_path in doc_ids]
+        for doc_path in deleted_docs:
+            self.live_docs.delete(doc_ids[doc_path])
+        self.live_docs.save()
+        with open("indexes/" + self.collection_path + "/deleted_docs", 'a') as deleted_docs_file:
+            for doc_path in deleted_docs:
+                deleted_docs_file.write("%s\n" % doc_path)
+        return len(deleted_docs)
+
+    def drop_deleted_documents(self):
+        """Keep the documents deleted from the previous index out of the blocks, before building a new index.
+
+        The deleted documents keep their doc id, so that the collection folder can be indexed again (see segments.py).
+        """
+        deleted_docs = set()
+        if exists("indexes/" + self.collection_path + "/deleted_docs"):
+            with open("indexes/" + self.collection_path + "/deleted_docs") as deleted_docs_file:
+                deleted_docs = set([line[:-1] for line in deleted_docs_file])
+        self.live_docs = LiveDocs()
+        doc_map = self.id_storer.doc_map
+        for block in self.blocks:
+            for doc_id in block.documents:
+                if doc_map[doc_id] in deleted_docs:
+                    self.live_docs.delete(doc_id)
+            block.documents = [doc_id for doc_id in block.documents if self.live_docs.is_live(doc_id)]
+
+    def load_maps(self):
+        """Replace the maps built from the collection folder with the ones stored with the last index.
+
+        Doc ids depend on the order in which documents are found: documents added since then would shift them.
+        """
+        self.id_storer.doc_map = DocMap()
+        self.id_storer.update_doc_map(DocStore("indexes/" + self.collection_path + "/docmap"))
+        self.id_storer.term_map = TermDictionary("indexes/" + self.collection_path + "/termdict")
+        self.live_docs = LiveDocs("indexes/" + self.collection_path + "/livedocs")
 
     def __len__(self):
         return self.id_storer.get_doc_counter()
 
 
+class LiveDocs(object):
+    """
+    A bitmap of the deleted doc ids of a collection, one bit per document: any other document is live.
+
+    The bitmap is saved after each deletion and reloaded by refresh when its file changes, so that the deletions made by
+    another process reach a running engine within one query.
+    """
+
+    def __init__(self, file_path=None):
+        self.file_path = file_path
+        self._bitmap = bytearray()
+        self._deleted_counter = 0
+        self._mtime = None
+        self.refresh()
+
+    def __len__(self):
+        """Return the amount of deleted documents."""
+        return self._deleted_counter
+
+    def refresh(self):
+        if self.file_path is not None and exists(self.file_path) and getmtime(self.file_path) != self._mtime:
+            self._mtime = getmtime(self.file_path)
+            with open(self.file_path, 'rb') as bitmap_file:
+                self._bitmap = bytearray(bitmap_file.read())
+            self._deleted_counter = sum([bin(byte).count("1") for byte in self._bitmap])
+
+    def save(self):
+        make_dirs(self.file_path)
+        with open(self.file_path + ".tmp", 'wb') as bitmap_file:
+            bitmap_file.write(self._bitmap)
+        replace(self.file_path + ".tmp", self.file_path)  # a concurrent refresh never reads a partial bitmap
+        self._mtime = getmtime(self.file_path)
+
+    def is_live(self, doc_id):
+        byte = doc_id >> 3
+        return byte >= len(self._bitmap) or not self._bitmap[byte] >> (doc_id & 7) & 1
+
+    def delete(self, doc_id):
+        byte = doc_id >> 3
+        if byte >= len(self._bitmap):
+            self._bitmap.extend(bytes(byte + 1 - len(self._bitmap)))
+        if self.is_live(doc_id):
+            self._bitmap[byte] |= 1 << (doc_id & 7)
+            self._deleted_counter += 1
+
+    def filter(self, doc_ids, values):
+        """Return the postings of a posting list whose document is live, as (doc_ids, values) NumPy arrays."""
+        if self._deleted_counter == 0:
+            return doc_ids, values
+        bitmap = np.frombuffer(self._bitmap, dtype=np.uint8)
+        doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        deleted = np.zeros(len(doc_ids), dtype=bool)
+        in_bitmap = (doc_ids >> 3) < len(bitmap)
+        deleted[in_bitmap] = bitmap[doc_ids[in_bitmap] >> 3] >> (doc_ids[in_bitmap] & 7) & 1
+        return doc_ids[~deleted], values[~deleted]
+
+
 class IDStorer(object):
 
     def __init__(self):
         self._doc_counter = 0
         self._term_counter = 0
-        self.doc_map = dict()
+        self.doc_map = DocMap()
         self.term_map = dict()
         self.lock = Lock()
 
@@ -67,6 +177,11 @@ class IDStorer(object):
         self.doc_map[self._doc_counter] = doc_path
         return self._doc_counter
 
+    def update_doc_map(self, doc_map):
+        """Add a {doc_id: doc_path} map of already indexed documents, e.g. a DocStore."""
+        self.doc_map.update(doc_map)
+        self._doc_counter = self.doc_map.last_doc_id
+
     def add_term(self, term):
         with self.lock:
             self._term_counter += 1
@@ -0,0 +1,130 @@
+import mmap
+import struct
+from bisect import bisect_right
+from collections.abc import Mapping
+from os import replace
+
+from utils import make_dirs
+
+_HEADER = struct.Struct('<4sIII')  # magic number, first doc id, amount of documents, amount of directories
+_MAGIC = b"TSS1"
+_OFFSETS = struct.Struct('<QQ')
+
+
+class DocStore(Mapping):
+    """
+    A read-only {doc_id: doc_path} map on a contiguous range of doc ids, stored in a binary file and read through mmap.
+
+    A document path is split into its directory and its file name. Directories are stored once, in a table, since
+    all the documents of a block share the same one. The header is followed by the offsets of the file names (one per
+    document, plus the end of the last one), the directory of each document, the offsets of the directories and a
+    single UTF-8 blob holding the directories then the file names.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as store_file:
+            self._data = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.first_doc_id, self._length, directories_amount = _HEADER.unpack_from(self._data)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a doc store: build the index again" % file_path)
+        self.last_doc_id = self.first_doc_id + self._length - 1
+        self._directories_start = _HEADER.size + 8 * (self._length + 1)
+        directory_offsets = struct.unpack_from('<%iQ' % (directories_amount + 1), self._data,
+                                               self._directories_start + 4 * self._length)
+        self._directories = [self._data[start:end].decode()  # only a few directories: one per block
+                             for start, end in zip(directory_offsets, directory_offsets[1:])]
+
+    @staticmethod
+    def write(doc_map, file_path):
+        """
+        Write a doc store, replacing any existing file at once.
+        :param doc_map: {doc_id: doc_path}, on a contiguous range of doc ids
+        """
+        doc_ids = sorted(doc_map)
+        if len(doc_ids) > 0 and doc_ids[-1] - doc_ids[0] != len(doc_ids) - 1:
+            raise ValueError("a doc store holds a contiguous range of doc ids")
+        directory_ids, doc_directories, names = dict(), list(), list()
+        for doc_id in doc_ids:
+            directory, separator, name = doc_map[doc_id].rpartition("/")
+            doc_directories.append(directory_ids.setdefault(directory + separator, len(directory_ids)))
+            names.append(name.encode())
+        directories = [directory.encode() for directory in directory_ids]  # ordered by directory id
+        blob_start = _HEADER.size + 8 * (len(names) + 1) + 4 * len(names) + 8 * (len(directories) + 1)
+        directory_offsets = [blob_start]
+        for directory in directories:
+            directory_offsets.append(directory_offsets[-1] + len(directory))
+        name_offsets = [directory_offsets[-1]]
+        for name in names:
+            name_offsets.append(name_offsets[-1] + len(name))
+        make_dirs(file_path)
+        with open(file_path + ".tmp", 'wb') as store_file:
+            store_file.write(_HEADER.pack(_MAGIC, doc_ids[0] if len(doc_ids) > 0 else 1, len(names), len(directories)))
+            store_file.write(struct.pack('<%iQ' % len(name_offsets), *name_offsets))
+            store_file.write(struct.pack('<%iI' % len(doc_directories), *doc_directories))
+            store_file.write(struct.pack('<%iQ' % len(directory_offsets), *directory_offsets))
+            store_file.write(b"".join(directories))
+            store_file.write(b"".join(names))
+        replace(file_path + ".tmp", file_path)  # a doc store is never read while being written
+
+    def __len__(self):
+        return self._length
+
+    def __contains__(self, doc_id):
+        return self.first_doc_id <= doc_id <= self.last_doc_id
+
+    def __getitem__(self, doc_id):
+        if not self.first_doc_id <= doc_id <= self.last_doc_id:
+            raise KeyError(doc_id)
+        index = doc_id - self.first_doc_id
+        start, end = _OFFSETS.unpack_from(self._data, _HEADER.size + 8 * index)
+        directory = struct.unpack_from('<I', self._data, self._directories_start + 4 * index)[0]
+        return self._directories[directory] + self._data[start:end].decode()
+
+    def __iter__(self):
+        return iter(range(self.first_doc_id, self.last_doc_id + 1))
+
+
+class DocMap(Mapping):
+    """
+    The {doc_id: doc_path} map of a collection: the doc stores of its index and of its segments, which are not loaded
+    in memory, followed by the documents added since, held in a dict.
+    """
+
+    def __init__(self):
+        self._stores = list()  # ordered by doc ids
+        self._first_doc_ids = list()
+        self._added = dict()
+        self.last_doc_id = 0
+
+    def __setitem__(self, doc_id, doc_path):
+        self._added[doc_id] = doc_path
+        self.last_doc_id = max(self.last_doc_id, doc_id)
+
+    def update(self, doc_map):
+        """Add a {doc_id: doc_path} map: a DocStore is kept as is rather than copied."""
+        if not isinstance(doc_map, DocStore):
+            for doc_id, doc_path in doc_map.items():
+                self[doc_id] = doc_path
+        elif len(doc_map) > 0:
+            index = bisect_right(self._first_doc_ids, doc_map.first_doc_id)
+            self._stores.insert(index, doc_map)
+            self._first_doc_ids.insert(index, doc_map.first_doc_id)
+            self.last_doc_id = max(self.last_doc_id, doc_map.last_doc_id)
+
+    def __getitem__(self, doc_id):
+        doc_path = self._added.get(doc_id)
+        if doc_path is not None:
+            return doc_path
+        index = bisect_right(self._first_doc_ids, doc_id) - 1
+        if index >= 0 and doc_id <= self._stores[index].last_doc_id:
+            return self._stores[index][doc_id]
+        raise KeyError(doc_id)
+
+    def __len__(self):
+        return sum([len(store) for store in self._stores]) + len(self._added)
+
+    def __iter__(self):
+        for store in self._stores:
+            yield from store
+        yield from self._added
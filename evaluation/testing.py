@@ -68,9 +68,11 @@ class TestBuilder(object):
     def test(self, collection_path):
         # type: (str) -> None
         import matplotlib.pyplot as plt
+        c = Collection(collection_path, verbose=False)
+        positions = build_index(c, 0, verbose=False, raw_frequencies=True)  # each weight function applies at query time
         for i in range(len(WeightFactory.weightClasses)):
             self.printer.print_test_progress(i+1, len(WeightFactory.weightClasses))
-            curve = self._weight_test(collection_path, i)
+            curve = self._weight_test(c, positions, i)
             plt.plot(*zip(*curve.points), marker="x", label="#%i (MAP: %.3f)" % (i+1, curve.get_mean_average_precision()))
         plt.legend(loc='upper right', shadow=True, fontsize='x-large')
         plt.xlabel("Recall")
@@ -79,11 +81,10 @@ class TestBuilder(object):
         plt.ylim((0, 1))
         plt.show()
 
-    def _weight_test(self, collection_path, weight_function_id):
-        # type: (str, int) -> MeanCurve
-        c = Collection(collection_path, verbose=False)
-        positions = build_index(c, weight_function_id, verbose=False)
-        runner = VectorQueryParser(c, "indexes/%s.index" % c.collection_path, positions, verbose=False)
+    def _weight_test(self, c, positions, weight_function_id):
+        # type: (Collection, np.ndarray, int) -> MeanCurve
+        runner = VectorQueryParser(c, "indexes/%s.index" % c.collection_path, positions, verbose=False,
+                                   weight_function_id=weight_function_id)
         eb = EvaluationBuilder()
         query_counter = 0
         for sup_query in self.queries:
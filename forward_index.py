@@ -0,0 +1,141 @@
+import struct
+from os import remove, replace
+
+import numpy as np
+
+from utils import make_dirs, encode_term_vectors, decode_term_vectors
+
+_HEADER = struct.Struct('<4sII')  # magic number, first doc id, amount of documents
+_MAGIC = b"TSF2"
+_PAIR_DTYPE = np.dtype([('term_id', '<i4'), ('weight', '<f4')])  # the layout of the pairs while the index is merged
+
+
+def _offsets_start(docs_amount):
+    """Return the position of the byte offsets of the term ids of the documents, after their pair offsets."""
+    return _HEADER.size + 8 * (docs_amount + 1)
+
+
+def _weights_start(docs_amount):
+    return _HEADER.size + 16 * (docs_amount + 1)
+
+
+def _write_vectors(file_path, first_doc_id, offsets, term_ids, weights, batch_size=2**20):
+    """
+    Write a forward index, replacing the file at once.
+    :param offsets: the index of the first pair of each document in term_ids and weights, plus the end, from 0
+    :param term_ids: the increasing term ids of each document, concatenated, e.g. a mapped array
+    :param weights: the weights of the pairs, e.g. a mapped array
+    :param batch_size: the amount of pairs encoded at once, at least
+    """
+    docs_amount = len(offsets) - 1
+    byte_offsets = np.zeros(docs_amount + 1, dtype=np.int64)
+    with open(file_path + ".tmp", 'wb') as forward_file:
+        forward_file.write(_HEADER.pack(_MAGIC, first_doc_id, docs_amount))
+        forward_file.write(np.asarray(offsets, dtype='<i8').tobytes())
+        forward_file.seek(_weights_start(docs_amount))
+        for start in range(0, len(weights), batch_size):
+            forward_file.write(np.asarray(weights[start:start + batch_size], dtype='<f4').tobytes())
+        doc, byte_offset = 0, 0
+        while doc < docs_amount:  # the term ids are encoded a batch of whole documents at a time
+            end = max(doc + 1, int(np.searchsorted(offsets, offsets[doc] + batch_size, side='right')) - 1)
+            end = min(end, docs_amount)
+            batch_offsets = np.asarray(offsets[doc:end + 1], dtype=np.int64) - offsets[doc]
+            encoded, batch_byte_offsets = encode_term_vectors(term_ids[offsets[doc]:offsets[end]], batch_offsets)
+            byte_offsets[doc + 1:end + 1] = byte_offset + batch_byte_offsets[1:]
+            forward_file.write(encoded)
+            doc, byte_offset = end, byte_offset + len(encoded)
+        forward_file.seek(_offsets_start(docs_amount))
+        forward_file.write(byte_offsets.astype('<i8').tobytes())
+    replace(file_path + ".tmp", file_path)  # a query parser may still map the previous file
+
+
+class ForwardIndexWriter(object):
+    """
+    Write the forward index of a range of doc ids while the inverted index is merged, one posting list at a time.
+
+    The amount of terms of each document is known from the Parse step, so the (term_id, weight) pairs of each document
+    are given their slot in a scratch file, mapped in memory and filled in place, before the posting lists are read.
+    The term ids are encoded once the index is merged.
+    """
+
+    def __init__(self, file_path, first_doc_id, doc_term_counts):
+        """
+        :param doc_term_counts: the amount of distinct terms of each document, indexed by doc_id - first_doc_id
+        """
+        self.file_path = file_path
+        self.first_doc_id = first_doc_id
+        self._offsets = np.concatenate(([0], np.cumsum(doc_term_counts, dtype=np.int64)))
+        self._filled = np.zeros(len(doc_term_counts), dtype=np.int64)
+        make_dirs(file_path)
+        with open(file_path + ".pairs", 'wb') as pairs_file:
+            pairs_file.truncate(_PAIR_DTYPE.itemsize * int(self._offsets[-1]))
+        self._pairs = np.empty(0, dtype=_PAIR_DTYPE)
+        if self._offsets[-1] > 0:  # mmap cannot map an empty array
+            self._pairs = np.memmap(file_path + ".pairs", dtype=_PAIR_DTYPE, mode='r+',
+                                    shape=(int(self._offsets[-1]),))
+
+    def append(self, term_id, doc_ids, weights):
+        """Add a posting list: term ids must be appended in increasing order, so that the vectors are sorted."""
+        indexes = np.asarray(doc_ids, dtype=np.int64) - self.first_doc_id
+        slots = self._offsets[indexes] + self._filled[indexes]
+        self._pairs['term_id'][slots] = term_id
+        self._pairs['weight'][slots] = weights
+        self._filled[indexes] += 1
+
+    def close(self):
+        _write_vectors(self.file_path, self.first_doc_id, self._offsets, self._pairs['term_id'], self._pairs['weight'])
+        del self._pairs
+        remove(self.file_path + ".pairs")
+
+
+class ForwardIndex(object):
+    """
+    The vector of each document of a range of doc ids, i.e. its (term_id, weight) pairs sorted by term id, stored
+    contiguously in a binary file and read through mmap.
+
+    The header is followed by the index of the first pair of each document (plus the end of the last one), the byte
+    offset of its term ids (plus the end), the weights of all the documents, as 4-byte floats, and their term ids, as
+    the varints of the gaps between the term ids of each document (see utils.encode_term_vectors).
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as forward_file:
+            magic, self.first_doc_id, self._length = _HEADER.unpack(forward_file.read(_HEADER.size))
+        if magic != _MAGIC:
+            raise ValueError("%s is not a forward index: build the index again" % file_path)
+        self._offsets = np.memmap(file_path, dtype='<i8', mode='r', offset=_HEADER.size, shape=(self._length + 1,))
+        self._byte_offsets = np.memmap(file_path, dtype='<i8', mode='r', offset=_offsets_start(self._length),
+                                       shape=(self._length + 1,))
+        self._weights = np.empty(0, dtype='<f4')
+        self._term_ids_bin = np.empty(0, dtype=np.uint8)
+        if self._offsets[-1] > 0:  # mmap cannot map an empty array
+            self._weights = np.memmap(file_path, dtype='<f4', mode='r', offset=_weights_start(self._length),
+                                      shape=(int(self._offsets[-1]),))
+            self._term_ids_bin = np.memmap(file_path, dtype=np.uint8, mode='r',
+                                           offset=_weights_start(self._length) + 4 * int(self._offsets[-1]),
+                                           shape=(int(self._byte_offsets[-1]),))
+
+    def __contains__(self, doc_id):
+        return self.first_doc_id <= doc_id < self.first_doc_id + self._length
+
+    def get(self, doc_id):
+        """Return the vector of a document as (term_ids, weights) NumPy arrays, the weights being a view on the file."""
+        index = doc_id - self.first_doc_id
+        start, end = int(self._offsets[index]), int(self._offsets[index + 1])
+        raw_bin = self._term_ids_bin[int(self._byte_offsets[index]):int(self._byte_offsets[index + 1])].tobytes()
+        return decode_term_vectors(raw_bin, np.array([0, end - start])), self._weights[start:end]
+
+    @staticmethod
+    def remap_terms(file_path, new_term_ids):
+        """
+        Rewrite a forward index with new term ids, e.g. after a compaction, replacing the file at once. The pairs of the
+        removed terms, only found in deleted documents, are removed.
+        :param new_term_ids: a NumPy array of the new id of each old term id, 0 for a removed term
+        """
+        forward_index = ForwardIndex(file_path)
+        offsets = np.array(forward_index._offsets)
+        term_ids = new_term_ids[decode_term_vectors(forward_index._term_ids_bin.tobytes(), offsets)]
+        kept = term_ids > 0
+        _write_vectors(file_path, forward_index.first_doc_id, np.concatenate(([0], np.cumsum(kept)))[offsets],
+                       term_ids[kept], forward_index._weights[kept])
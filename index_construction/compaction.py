@@ -0,0 +1,75 @@
+from array import array
+from os import replace
+from os.path import exists
+
+import numpy as np
+
+from forward_index import ForwardIndex
+from positional_index import PositionalIndex, PositionalIndexWriter
+from index_construction.index_IO import SequentialIndexWriter
+from index_construction.weights import CollectionStats
+from term_dictionary import TermDictionary
+from utils import load_positions, save_positions, decode_posting_list, check_index_header, encode_positions, \
+    REFINED_POSTING_DTYPE
+
+
+def compact_index(index_path, live_docs, raw_frequencies, capacity=64 * 2**20):
+    """
+    Rewrite an index, its positions and its term dictionary without the postings of the deleted documents.
+
+    Terms left without postings are removed: the remaining terms are given new ids, still in lexicographic order, which
+    the forward index is rewritten with. The positional index, if any, is rewritten along the index.
+
+    The statistics of a raw-frequency index are updated along its posting lists: the df of a term is read from its
+    compacted posting list at query time, so its cf, the collection size and the average document length only count
+    the live documents too. The weights of a weighted index, and the cf they were computed with, are kept as they were
+    built.
+    :param index_path: the path of the index relative to indexes/, i.e. a collection path or a segment path
+    :param raw_frequencies: True if the index stores raw frequencies, False if it stores weights
+    :param capacity: the amount of bytes the writer may buffer
+    :return: (positions, TermDictionary, amount of postings removed)
+    """
+    positions = load_positions("indexes/" + index_path + "/positions")
+    writer = SequentialIndexWriter("indexes/" + index_path + ".index.tmp", capacity, refined=True)
+    live_terms = list()
+    new_term_ids = np.zeros(len(positions) + 1, dtype=np.int32)  # 0 for a removed term
+    positional_index, positional_writer = None, None
+    if exists("indexes/" + index_path + "/positional"):
+        positional_index = PositionalIndex("indexes/" + index_path + "/positional")
+        positional_writer = PositionalIndexWriter("indexes/" + index_path + "/positional")
+    stats = CollectionStats.load("indexes/" + index_path + "/stats")
+    collection_frequencies = array('q')
+    removed_postings = 0
+    with open("indexes/" + index_path + ".index", 'rb') as index_file:
+        check_index_header(index_file)
+        for index, term in enumerate(TermDictionary("indexes/" + index_path + "/termdict")):  # ordered by term id
+            size = -1 if index == len(positions) - 1 else positions[index + 1] - positions[index]
+            doc_ids, weights = decode_posting_list(index_file.read(size), refined=True)[1:]
+            live_doc_ids, live_weights = live_docs.filter(doc_ids, weights)
+            removed_postings += len(doc_ids) - len(live_doc_ids)
+            if len(live_doc_ids) > 0:
+                live_posting_list = np.empty(len(live_doc_ids), dtype=REFINED_POSTING_DTYPE)
+                live_posting_list['doc_id'], live_posting_list['weight'] = live_doc_ids, live_weights
+                live_terms.append(term)
+                new_term_ids[index + 1] = len(live_terms)
+                collection_frequencies.append(int(live_weights.sum()) if raw_frequencies
+                                              else int(stats.collection_frequencies[index]))
+                writer.append((len(live_terms), live_posting_list))
+                if positional_writer is not None:
+                    live_ranks = live_docs.filter(doc_ids, np.arange(len(doc_ids)))[1]
+                    owners, term_positions = positional_index.get(index + 1, live_ranks)
+                    tfs = np.bincount(owners, minlength=len(live_ranks))
+                    positional_writer.append(tfs, encode_positions(term_positions, tfs))
+    writer.close()
+    if positional_writer is not None:
+        positional_writer.close()
+    replace("indexes/" + index_path + ".index.tmp", "indexes/" + index_path + ".index")
+    save_positions(writer.positions, "indexes/" + index_path + "/positions")
+    TermDictionary.write(live_terms, "indexes/" + index_path + "/termdict")
+    if exists("indexes/" + index_path + "/forward"):
+        ForwardIndex.remap_terms("indexes/" + index_path + "/forward", new_term_ids)
+    stats.collection_frequencies = np.frombuffer(collection_frequencies, dtype=np.int64)
+    stats.remove_deleted_documents(live_docs)
+    stats.save("indexes/" + index_path + "/stats")
+    positions = load_positions("indexes/" + index_path + "/positions")
+    return positions, TermDictionary("indexes/" + index_path + "/termdict"), removed_postings
@@ -1,15 +1,58 @@
+import struct
 from collections import deque
-from queue import Queue
-
 from os import remove
-from threading import Thread
 
-from utils import term_index_to_bin, bin_to_term_index, make_dirs
+from threading import Thread, Condition, Lock
+
+from utils import term_index_to_bin, bin_to_term_index, check_index_header, make_dirs, INDEX_HEADER
+
+VOCABULARY_SUFFIX = ".terms"  # the vocabulary of a block index is stored in <block_index_path>.terms
+POSITIONAL_SUFFIX = ".positional"  # and the positions of its terms, if any, in <block_index_path>.positional
+_POSITIONS_SIZE = struct.Struct('<I')
+
+
+class ByteBudgetQueue(object):
+    """
+    A thread-safe FIFO queue whose capacity is expressed in bytes.
+
+    put blocks while the queue is not empty and the new item would exceed the capacity. Hence an item bigger than the
+    capacity is still accepted, but only once the queue has been emptied.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = deque()
+        self._size = 0
+        self._lock = Lock()
+        self._not_empty = Condition(self._lock)
+        self._not_full = Condition(self._lock)
+
+    def put(self, item, size):
+        with self._not_full:
+            while len(self._items) > 0 and self._size + size > self.capacity:
+                self._not_full.wait()
+            self._items.append((item, size))
+            self._size += size
+            self._not_empty.notify()
+
+    def get(self):
+        with self._not_empty:
+            while len(self._items) == 0:
+                self._not_empty.wait()
+            item, size = self._items.popleft()
+            self._size -= size
+            self._not_full.notify()
+            return item
 
 
 class SequentialIndexReader(Thread):
     """
-    An implementation of a reading queue with a fixed capacity.
+    An implementation of a reading queue with a fixed capacity, expressed in bytes.
+
+    The queue buffers the posting lists in their binary form: the size of each one is given by the positions map.
+    Only the head of the queue is decoded. The local term ids of the block index are replaced by the terms of its
+    vocabulary, which is read along. The queue always ends, even if reading fails: the error is then kept in
+    self.error.
     """
 
     def __init__(self, file_path, positions, capacity):
@@ -17,19 +60,33 @@ class SequentialIndexReader(Thread):
         self.daemon = True
         self._positions = positions
         self.file_path = file_path
-        self._read_buffer = Queue(capacity)
+        self._read_buffer = ByteBudgetQueue(capacity)
         self._head = None
+        self.error = None
 
     def run(self):
-        with open(self.file_path, 'rb') as index_file:
-            index_file.seek(self._positions[0])
-            while len(self._positions) > 0:
-                new_bin = self._read_next_binary_list(index_file)
-                self._read_buffer.put(bin_to_term_index(new_bin))
-        self._read_buffer.put(None)
+        try:
+            with open(self.file_path, 'rb') as index_file, \
+                    open(self.file_path + VOCABULARY_SUFFIX) as vocabulary_file:
+                check_index_header(index_file)
+                if len(self._positions) > 0:  # a run may be empty if its documents only contain common words
+                    index_file.seek(self._positions[0])
+                while len(self._positions) > 0:
+                    new_bin = self._read_next_binary_list(index_file)
+                    term = vocabulary_file.readline()[:-1]
+                    self._read_buffer.put((term, new_bin), len(term) + len(new_bin))
+        except Exception as error:
+            self.error = error
+            raise
+        finally:
+            self._read_buffer.put(None, 0)  # the merger never waits for a reader that stopped
 
     def wait_for_readiness(self):
-        self._head = self._read_buffer.get()
+        self._head = self._get_next_term_index()
+
+    def _get_next_term_index(self):
+        item = self._read_buffer.get()
+        return None if item is None else (item[0], bin_to_term_index(item[1])[1])
 
     def _read_next_binary_list(self, file):
         current_position = self._positions.popleft()
@@ -39,52 +96,75 @@ class SequentialIndexReader(Thread):
             size = self._positions[0] - current_position
         return file.read(size)
 
-    def _fill_queue(self):
-        if self._read_buffer.empty():
-            with open(self.file_path, 'rb') as index_file:
-                if len(self._positions) == 0:
-                    return
-                index_file.seek(self._positions[0])
-                while not self._read_buffer.full() and len(self._positions) > 0:
-                    new_bin = self._read_next_binary_list(index_file)
-                    self._read_buffer.put(bin_to_term_index(new_bin))
-
     def pop(self):
-        head = self._head[0], list(self._head[1])  # return a copy of _head not a pointer to it
-        self._head = self._read_buffer.get()
+        head = self._head
+        self._head = self._get_next_term_index()
         return head
 
     def peek(self):
         return self._head
 
 
+def write_block_positions(file_path, vocabulary, term_positions):
+    """
+    Write the positions of the terms of a block index, in the order of its vocabulary: the positions of a term are its
+    size, as a 4-byte int, then the positions of each of its postings (see utils.encode_positions).
+    :param term_positions: {term: [encoded positions of each posting]}
+    """
+    with open(file_path + POSITIONAL_SUFFIX, 'wb') as positions_file:
+        for term in vocabulary:
+            gaps_bin = b"".join(term_positions[term])
+            positions_file.write(_POSITIONS_SIZE.pack(len(gaps_bin)))
+            positions_file.write(gaps_bin)
+
+
+class BlockPositionsReader(object):
+    """Read the positions of the terms of a block index, in the order of its vocabulary (see write_block_positions)."""
+
+    def __init__(self, file_path):
+        self.file_path = file_path + POSITIONAL_SUFFIX
+        self._file = open(self.file_path, 'rb')
+
+    def pop(self):
+        return self._file.read(_POSITIONS_SIZE.unpack(self._file.read(_POSITIONS_SIZE.size))[0])
+
+    def close(self):
+        self._file.close()
+        remove(self.file_path)
+
+
 class SequentialIndexWriter(object):
     """
-    An implementation of a writing queue with a fixed capacity.
+    An implementation of a writing queue with a fixed capacity, expressed in bytes.
+
+    Posting lists are encoded with the posting codec (see utils.term_index_to_bin) when appended, so the capacity bounds
+    the size of the buffered binaries.
     """
 
     def __init__(self, file_path, capacity, refined=False):
         self.file_path = file_path
         self._write_buffer = list()
+        self._buffered_bytes = 0
         self.capacity = capacity
-        self.refined= refined
+        self.refined = refined
         self.positions = deque()
-        try:  # because of the append mode, we first try to delete the existing file
-            remove(file_path)
-        except OSError:
-            pass
         make_dirs(file_path)  # recursively create the dirs in path if necessary
+        with open(file_path, 'wb') as index_file:  # the posting lists are then appended after the header
+            index_file.write(INDEX_HEADER)
 
     def _flush(self):
         with open(self.file_path, 'ab') as index_file:
-            for term_index in self._write_buffer:
+            for term_bin in self._write_buffer:
                 self.positions.append(index_file.tell())
-                index_file.write(term_index_to_bin(term_index, refined=self.refined))
+                index_file.write(term_bin)
         self._write_buffer = list()
+        self._buffered_bytes = 0
 
     def append(self, term_index):
-        self._write_buffer.append(term_index)
-        if len(self._write_buffer) >= self.capacity:
+        term_bin = term_index_to_bin(term_index, refined=self.refined)
+        self._write_buffer.append(term_bin)
+        self._buffered_bytes += len(term_bin)
+        if self._buffered_bytes >= self.capacity:
             self._flush()
 
     def close(self):
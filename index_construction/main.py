@@ -1,22 +1,95 @@
+from os import remove
+from os.path import exists
 import time
 
+from index_construction.compaction import compact_index
 from index_construction.merge import BlockIndexMerger
-from index_construction.parse import DefaultParseManager
+from index_construction.parse import DefaultParseManager, MultiProcessParseManager, SpimiParseManager
+from index_construction.segments import remove_segments
 from index_construction.weights import WeightFactory
+from positional_index import OFFSETS_SUFFIX
+from utils import load_map, save_map
 
 
-def build_index(collection, weight_function_id, verbose, memory=2200):
+def build_index(collection, weight_function_id, verbose, memory=64 * 2**20, processes=0, run_memory=None,
+                raw_frequencies=False, positional=False, forward=False):
+    """Build the index of a collection.
+
+    :param memory: the amount of bytes of posting lists the Merge step may buffer
+    :param processes: the amount of parse worker processes (None for one per CPU), 0 to parse blocks in threads
+    :param run_memory: if set, ignore the blocks and parse in SPIMI mode, flushing a run every run_memory bytes
+    :param raw_frequencies: if True, store the frequencies and the statistics of the collection instead of the weights:
+    the weight function is then applied at query time, and can be changed without building the index again
+    :param positional: if True, also store the positions of the terms in the documents, for phrase and proximity
+    queries
+    :param forward: if True, also store the vector of each document in a forward index, for query expansion
+    """
+    collection.drop_deleted_documents()
     weighter = WeightFactory.get_weight_function(weight_function_id, len(collection))
-    p = DefaultParseManager(weighter.stats, verbose)
+    if run_memory is not None:
+        p = SpimiParseManager(weighter.stats, verbose, run_memory, positional)
+    elif processes == 0:
+        p = DefaultParseManager(weighter.stats, verbose, positional)
+    else:
+        p = MultiProcessParseManager(weighter.stats, verbose, processes, positional)
     start = time.time()
-    p.parse(collection)
+    p.parse(collection)  # the statistics only count the live documents, although the deleted ones keep their doc id
+    p.printer.print_stemmer_cache_message(*p.get_stemmer_cache_info())
     parsing_end = time.time()
-    collection.store_maps()
-    b = BlockIndexMerger(collection, p.block_positions, weighter, memory, verbose)
+    b = BlockIndexMerger(collection, p.block_positions, weighter, memory, verbose, raw_frequencies, positional,
+                         forward)
     del p
     positions = b.merge()
+    collection.store_maps()  # the term ids are assigned during the Merge step
+    weighter.stats.save("indexes/%s/stats" % collection.collection_path)  # the segments are weighted along the index
+    save_map({"weight_function_id": weight_function_id, "raw_frequencies": int(raw_frequencies),
+              "positional": int(positional), "forward": int(forward)},
+             "indexes/%s/settings" % collection.collection_path)
+    positional_path = "indexes/%s/positional" % collection.collection_path
+    if not positional and exists(positional_path):  # the positions of a previous index
+        remove(positional_path)
+        remove(positional_path + OFFSETS_SUFFIX)
+    forward_path = "indexes/%s/forward" % collection.collection_path
+    if not forward and exists(forward_path):  # the vectors of a previous index
+        remove(forward_path)
+    remove_segments(collection.collection_path)  # the new index covers the documents of the old segments
     merging_end = time.time()
     tot = merging_end - start
     print("Index built in %.2f sec:\n\tParse: %.2f sec\n\tMerge: %.2f sec"
           % (tot, parsing_end - start, merging_end - parsing_end))
     return positions
+
+
+def switch_weight_function(collection, weight_function_id):
+    """Change the weight function applied at query time to a raw-frequency index, without building it again.
+
+    :return: False if the index of the collection stores weights, which can only change with a new build
+    """
+    settings = load_map("indexes/%s/settings" % collection.collection_path, value_type=int)
+    if settings.get("raw_frequencies", 0) != 1:
+        return False
+    settings["weight_function_id"] = weight_function_id
+    save_map(settings, "indexes/%s/settings" % collection.collection_path)
+    return True
+
+
+def compact(collection, segments=None, memory=64 * 2**20):
+    """Rewrite the index of a collection and its segments without the postings of the deleted documents.
+
+    Only a raw-frequency index is weighted with the statistics of the live documents afterwards, at query time: the
+    weights of a weighted index cannot be computed again without the frequencies, so they still account for the deleted
+    documents until the next full build.
+    :return: the new positions of the index
+    """
+    settings = load_map("indexes/%s/settings" % collection.collection_path, value_type=int)
+    if settings.get("raw_frequencies", 0) != 1:
+        print("The weights of the index still account for the deleted documents: build the index again to update them, "
+              "or with -r to update them at each compaction")
+    start = time.time()
+    positions, collection.id_storer.term_map, removed_postings = compact_index(
+        collection.collection_path, collection.live_docs, settings.get("raw_frequencies", 0) == 1, memory)
+    if segments is not None:
+        removed_postings += segments.compact()
+    print("Index compacted in %.2f sec: %i postings of %i deleted documents removed"
+          % (time.time() - start, removed_postings, len(collection.live_docs)))
+    return positions
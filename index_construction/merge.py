@@ -1,78 +1,146 @@
+from array import array
+import heapq
 from os import remove
+from os.path import getsize
+import time
 
-from index_construction.index_IO import SequentialIndexWriter, SequentialIndexReader
+import numpy as np
+
+from forward_index import ForwardIndexWriter
+from index_construction.index_IO import SequentialIndexWriter, SequentialIndexReader, BlockPositionsReader, \
+    VOCABULARY_SUFFIX
+from positional_index import PositionalIndexWriter
 from printer import MergePrinter
-from utils import save_positions
+from utils import load_positions, save_positions, REFINED_POSTING_DTYPE
 
 
 class BlockIndexMerger(object):
 
-    def __init__(self, collection, block_positions, weighter, total_capacity, verbose):
+    def __init__(self, collection, block_positions, weighter, total_capacity, verbose, raw_frequencies=False,
+                 positional=False, forward=False):
+        """
+        :param block_positions: {run_path: positions} of the block indexes sorted by term, ordered by doc ids
+        :param total_capacity: the amount of bytes shared by the read queues and the write queue
+        :param raw_frequencies: if True, store the frequencies in place of the weights, to weight them at query time
+        :param positional: if True, merge the positions written next to the block indexes into a positional index
+        :param forward: if True, also write the vector of each document into a forward index, for query expansion
+        """
         self._collection = collection
         self._readers = list()
-        self._capacity = total_capacity / (len(collection.blocks) + 1)
-        for block in collection.blocks:
-            self._readers.append(SequentialIndexReader("indexes/" + block.block_path,
-                                                       block_positions[block.block_path], self._capacity))
+        self._capacity = total_capacity / (len(block_positions) + 1)
+        for run_path in block_positions:
+            self._readers.append(SequentialIndexReader("indexes/" + run_path, block_positions[run_path],
+                                                       self._capacity))
         for reader in self._readers:
             reader.start()
         for reader in self._readers:
             reader.wait_for_readiness()  # makes sure the head of each read queue is correctly initiated
+        # (term, reader_id) of the head of each read queue: ties are popped in reader order, i.e. in doc id order
+        self._heap = [(reader.peek()[0], i) for i, reader in enumerate(self._readers) if reader.peek() is not None]
+        heapq.heapify(self._heap)
         self._writer = SequentialIndexWriter("indexes/" + self._collection.collection_path + ".index", self._capacity,
                                              refined=True)
+        self._forward_writer = None
+        if forward:
+            self._forward_writer = ForwardIndexWriter("indexes/" + self._collection.collection_path + "/forward",
+                                                      weighter.stats.first_doc_id, weighter.stats.doc_term_counts)
+        self._positions_readers = None
+        self._positional_writer = None
+        if positional:  # the positions of a term are read along its posting list, in the same order
+            self._positions_readers = [BlockPositionsReader("indexes/" + run_path) for run_path in block_positions]
+            self._positional_writer = PositionalIndexWriter("indexes/" + self._collection.collection_path +
+                                                            "/positional")
+        self._forward_time = 0  # the seconds spent writing the forward index
+        self._collection_frequencies = array('q')  # the cf of each term, by term id
         self.weighter = weighter
+        self.raw_frequencies = raw_frequencies
         self.printer = MergePrinter(verbose)
 
-    def _get_lexically_first(self):
-        result = float("inf")
-        reader_id = -1
-        for i in range(len(self._readers)):
-            reader = self._readers[i]
-            item = reader.peek()
-            if item is not None and int(item[0]) < result:
-                result = int(item[0])
-                reader_id = i
-        return None if reader_id < 0 else self._readers[reader_id].pop()
+    def _pop_lexically_first(self):
+        """Pop the lexically first term from all the readers that hold it and return its merged posting list, and its
+        positions in the documents of the posting list if the index is positional (None otherwise).
+
+        Global term ids are assigned here: they follow the lexicographic order of the terms.
+        """
+        if len(self._heap) == 0:
+            return None
+        heap = self._heap
+        term = heap[0][0]
+        posting_list = list()
+        positions = None if self._positions_readers is None else list()
+        while len(heap) > 0 and heap[0][0] == term:
+            reader_id = heap[0][1]
+            reader = self._readers[reader_id]
+            posting_list.extend(reader.pop()[1])
+            if positions is not None:
+                positions.append(self._positions_readers[reader_id].pop())
+            if reader.peek() is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (reader.peek()[0], reader_id))
+        if positions is not None:
+            positions = b"".join(positions)  # the runs are ordered by doc ids, like the postings
+        return self._collection.id_storer.add_term(term), posting_list, positions
 
     def _end(self):
         for reader in self._readers:
             remove(reader.file_path)
+            remove(reader.file_path + VOCABULARY_SUFFIX)
         self._writer.close()
+        if self._forward_writer is not None:
+            start = time.time()
+            self._forward_writer.close()
+            self._forward_time += time.time() - start
+            self.printer.print_forward_index_message(self._forward_time, getsize(self._forward_writer.file_path))
+        if self._positional_writer is not None:
+            for positions_reader in self._positions_readers:
+                positions_reader.close()
+            self._positional_writer.close()
 
     def refine_line(self, index_line):
+        """Weight a whole posting list at once and return it as an array of REFINED_POSTING_DTYPE.
+
+        The frequencies of a raw-frequency index are stored as they are (exactly, as 4-byte floats). The cf of the term
+        is kept in the statistics of the collection either way.
+        """
         term_id, posting_list = index_line
-        if self.weighter.weight_function_id == 6:
-            cf = sum([f for d_id, f in posting_list])
-            new_posting_list = [(doc, self.weighter.weight(doc, freq, len(posting_list), cf))
-                                for doc, freq in posting_list]
+        doc_ids, tfs = np.array(posting_list, dtype=np.int64).T
+        cf = int(tfs.sum())
+        self._collection_frequencies.append(cf)
+        if self.raw_frequencies:
+            weights = tfs
         else:
-            new_posting_list = [(doc, self.weighter.weight(doc, freq, len(posting_list)))
-                                for doc, freq in posting_list]
+            weights = self.weighter.weight_frequencies(doc_ids, tfs, len(posting_list), cf)
         # self.n_d[doc_id] = self.n_d.get(doc_id, 0) + temp_weight*temp_weight
         # / ! \ Nd not computed any more!
+        new_posting_list = np.empty(len(posting_list), dtype=REFINED_POSTING_DTYPE)
+        new_posting_list['doc_id'] = doc_ids
+        new_posting_list['weight'] = weights
         return new_posting_list
 
     def merge(self):
         self.printer.print_merge_start_message()
         counter = 0
-        last_term = self._get_lexically_first()
-        postings_counter = len(last_term[1])
-        while last_term is not None:
-            next_term = self._get_lexically_first()
-            if next_term is not None and last_term[0] == next_term[0]:
-                postings_counter += len(next_term[1])
-                last_term = last_term[0], (last_term[1] + next_term[1])
-            else:
-                if postings_counter != len(last_term[1]):
-                    raise ValueError("Postings were lost")
-                self._writer.append((last_term[0], self.refine_line(last_term)))
-                counter += 1
-                last_term = next_term
-                if last_term is not None:
-                    postings_counter = len(last_term[1])
-                if counter % 25000 == 0:
-                    self.printer.print_merge_progress_message(counter)
+        term_index = self._pop_lexically_first()
+        while term_index is not None:
+            term_id, posting_list, positions = term_index
+            refined_line = self.refine_line((term_id, posting_list))
+            self._writer.append((term_id, refined_line))
+            if self._forward_writer is not None:
+                start = time.time()
+                self._forward_writer.append(term_id, refined_line['doc_id'], refined_line['weight'])
+                self._forward_time += time.time() - start
+            if positions is not None:
+                self._positional_writer.append([posting[1] for posting in posting_list], positions)
+            counter += 1
+            if counter % 25000 == 0:
+                self.printer.print_merge_progress_message(counter)
+            term_index = self._pop_lexically_first()
+        for reader in self._readers:
+            if reader.error is not None:  # the block index was not read to its end
+                raise reader.error
         self.printer.print_end_of_merge_message(counter)
+        self.weighter.stats.collection_frequencies = np.frombuffer(self._collection_frequencies, dtype=np.int64)
         self._end()
         save_positions(self._writer.positions, "indexes/" + self._collection.collection_path + "/positions")
-        return self._writer.positions
+        return load_positions("indexes/" + self._collection.collection_path + "/positions")
@@ -1,25 +1,39 @@
-from _operator import itemgetter
+from collections import OrderedDict
+from multiprocessing import Pool, cpu_count
+from os import getpid
 from threading import Thread, Lock
 
-from index_construction.index_IO import SequentialIndexWriter
+from index_construction.index_IO import SequentialIndexWriter, write_block_positions, VOCABULARY_SUFFIX
+from index_construction.weights import PartialCollectionStats
 
+from analyzer import Analyzer
 from printer import ParsePrinter
-from porterstemmer import Stemmer
+from utils import save_vocabulary, encode_positions
 
 
 class AbstractParseManager(object):
 
-    def __init__(self, stats, verbose):
-        self._cleaner = Cleaner()
+    def __init__(self, stats, verbose, positional=False):
+        """:param positional: if True, also write the positions of the terms in the documents next to each run"""
+        self._analyzer = Analyzer()
         self.printer = ParsePrinter(verbose)
         self.lock = Lock()
         self.stats = stats
+        self.positional = positional
         self._ended_threads = 0
-        self.block_positions = dict()
+        self.block_positions = OrderedDict()  # runs are ordered by doc ids so that merged posting lists stay sorted
 
     def parse(self, collection):
         """Start BlockParser workers on each block of the collection."""
         self.printer.print_block_parse_start_message(len(collection.blocks))
+        for block in collection.blocks:
+            self.block_positions[block.block_path] = None
+
+    def _check_parsed(self):
+        """Raise an error if a block index is missing, e.g. if its parser failed."""
+        missing = [block_path for block_path, positions in self.block_positions.items() if positions is None]
+        if len(missing) > 0:
+            raise RuntimeError("%i blocks were not parsed: %s" % (len(missing), ", ".join(missing)))
 
     def signal_job_done(self, block_path, positions):
         with self.lock:
@@ -27,76 +41,244 @@ class AbstractParseManager(object):
             self._ended_threads += 1
             self.printer.print_block_parse_end_message(self._ended_threads)
 
+    def get_stemmer_cache_info(self):
+        """Return the (hits, misses) counters of the stemmer cache."""
+        return self._analyzer.stemmer.get_cache_info()
+
 
 class DefaultParseManager(AbstractParseManager):
 
     def parse(self, collection):
         AbstractParseManager.parse(self, collection)
-        block_parsers = [DefaultBlockParser(self, block, collection.id_storer, self._cleaner, self.printer)
+        block_parsers = [DefaultBlockParser(self, block, collection.id_storer, self._analyzer, self.printer)
                          for block in collection.blocks]
         for parser in block_parsers:
             parser.start()
         for parser in block_parsers:
             parser.join()
-        self.stats.signal_end_of_merge()
+        for parser in block_parsers:
+            if parser.error is not None:
+                raise parser.error
+            self.stats.merge(parser.partial_stats)
+        self._check_parsed()
+        self.stats.signal_end_of_merge(collection.live_docs)
+
+
+class MultiProcessParseManager(AbstractParseManager):
+    """Parse the collection in a pool of worker processes to escape the GIL.
+
+    Blocks are split into as many jobs as needed to keep every worker busy. Each worker writes its sorted run and
+    returns its partial statistics, which the manager reduces.
+    """
+
+    def __init__(self, stats, verbose, processes=None, positional=False):
+        AbstractParseManager.__init__(self, stats, verbose, positional)
+        self.processes = processes or cpu_count()
+        self._workers_cache_info = dict()  # {pid: (hits, misses)} of the stemmer cache of each worker
+
+    def _split_jobs(self, collection):
+        doc_map = collection.id_storer.doc_map
+        parts = -(-self.processes // max(len(collection.blocks), 1))  # ceil division
+        jobs = list()
+        for block in collection.blocks:
+            documents = [(doc_id, doc_map[doc_id]) for doc_id in block.documents]
+            part_size = max(-(-len(documents) // parts), 1)
+            for part, begin in enumerate(range(0, len(documents), part_size)):
+                run_path = block.block_path if parts == 1 else "%s.%i" % (block.block_path, part)
+                jobs.append((run_path, documents[begin:begin + part_size]))
+        return jobs
+
+    def parse(self, collection):
+        self.printer.print_block_parse_start_message(len(collection.blocks))
+        jobs = self._split_jobs(collection)
+        for run_path, documents in jobs:
+            self.block_positions[run_path] = None
+        with Pool(self.processes, initializer=_init_parse_process, initargs=(self.positional,)) as pool:
+            for run_path, positions, run_stats, (pid, cache_info) in pool.imap_unordered(_parse_in_process, jobs):
+                self._workers_cache_info[pid] = cache_info
+                self.stats.merge(run_stats)
+                self.signal_job_done(run_path, positions)
+        self._check_parsed()
+        self.stats.signal_end_of_merge(collection.live_docs)
+
+    def get_stemmer_cache_info(self):
+        hits = sum([cache_info[0] for cache_info in self._workers_cache_info.values()])
+        misses = sum([cache_info[1] for cache_info in self._workers_cache_info.values()])
+        return hits, misses
+
+
+class SpimiParseManager(AbstractParseManager):
+    """Single-pass in-memory indexing (SPIMI).
+
+    Documents are streamed from all the blocks of the collection, whatever their size, into a single in-memory index.
+    A sorted run is flushed to the disk whenever the estimated size of this index reaches run_memory bytes.
+    """
+
+    _POSTING_MEMORY_SIZE = 100  # estimated size of a (doc_id, freq) posting in a Python list, in bytes
+    _TERM_MEMORY_SIZE = 200  # estimated size of a new entry of the in-memory index, in bytes
+    _POSITIONS_MEMORY_SIZE = 40  # estimated size of the encoded positions of a posting, without its bytes
+
+    def __init__(self, stats, verbose, run_memory, positional=False):
+        AbstractParseManager.__init__(self, stats, verbose, positional)
+        self.run_memory = run_memory
+
+    def parse(self, collection):
+        self.printer.print_spimi_parse_start_message(len(collection), self.run_memory)
+        parser = DefaultBlockParser(self, None, collection.id_storer, self._analyzer, self.printer)
+        id_storer = collection.id_storer
+        term_index = dict()
+        term_positions = dict() if self.positional else None
+        memory = 0
+        doc_ids = [doc_id for block in collection.blocks for doc_id in block.documents]  # runs are sorted by doc ids
+        for docs_counter, doc_id in enumerate(doc_ids, 1):
+            if self.positional:
+                doc_positions_dict = parser.parse_document_positions(id_storer.doc_map[doc_id])
+                doc_frequency_dict = {term: len(positions) for term, positions in doc_positions_dict.items()}
+            else:
+                doc_frequency_dict = parser.parse_document(id_storer.doc_map[doc_id])
+            parser.partial_stats.add_document(doc_id, doc_frequency_dict)
+            for term, freq in doc_frequency_dict.items():
+                occurrence_list = term_index.get(term)
+                if occurrence_list is None:
+                    occurrence_list = term_index[term] = list()
+                    memory += self._TERM_MEMORY_SIZE
+                occurrence_list.append((doc_id, freq))
+                memory += self._POSTING_MEMORY_SIZE
+                if term_positions is not None:
+                    positions_bin = encode_positions(doc_positions_dict[term])
+                    term_positions.setdefault(term, list()).append(positions_bin)
+                    memory += self._POSITIONS_MEMORY_SIZE + len(positions_bin)
+            if memory >= self.run_memory:
+                self._flush_run(collection, term_index, term_positions, docs_counter)
+                term_index = dict()
+                term_positions = dict() if self.positional else None
+                memory = 0
+        if len(term_index) > 0:
+            self._flush_run(collection, term_index, term_positions, len(doc_ids))
+        self.stats.merge(parser.partial_stats)
+        self.stats.signal_end_of_merge(collection.live_docs)
+
+    def _flush_run(self, collection, term_index, term_positions, docs_counter):
+        run_path = "%s/run-%i" % (collection.collection_path, len(self.block_positions))
+        self.block_positions[run_path] = write_block_index(run_path, term_index, term_positions)
+        self.printer.print_run_flush_message(len(self.block_positions), docs_counter)
+
+
+_process_analyzer = None
+_process_parser = None
+_process_positional = False
+
+
+def _init_parse_process(positional):
+    global _process_analyzer, _process_parser, _process_positional
+    _process_analyzer = Analyzer()
+    _process_parser = DefaultBlockParser(None, None, None, _process_analyzer, None)
+    _process_positional = positional
+
+
+def _parse_in_process(job):
+    """Parse and write a run of (doc_id, doc_path) in a worker process."""
+    run_path, documents = job
+    _process_parser.partial_stats = PartialCollectionStats()
+    term_positions = dict() if _process_positional else None
+    positions = write_block_index(run_path, _process_parser.parse_documents(documents, term_positions), term_positions)
+    cache_info = getpid(), _process_analyzer.stemmer.get_cache_info()
+    return run_path, positions, _process_parser.partial_stats, cache_info
+
+
+def write_block_index(run_path, term_index, term_positions=None):
+    """Write a block index sorted by term and return its positions.
+
+    Parsers do not share any term id: in the block index, each term is replaced by its rank in the vocabulary of the
+    block, which is written next to it. Global term ids are assigned during the Merge step.
+    :param term_positions: if given, {term: [encoded positions of each posting]}, written next to the block index too
+    """
+    vocabulary = sorted(term_index)
+    writer = SequentialIndexWriter("indexes/" + run_path, float("inf"))  # the whole block index is already in memory
+    for local_id, term in enumerate(vocabulary):
+        writer.append((local_id, term_index[term]))
+    writer.close()
+    save_vocabulary(vocabulary, "indexes/" + run_path + VOCABULARY_SUFFIX)
+    if term_positions is not None:
+        write_block_positions("indexes/" + run_path, vocabulary, term_positions)
+    return writer.positions
 
 
 class AbstractBlockParser(Thread):
 
-    def __init__(self, manager, block, id_storer, cleaner, printer):
+    def __init__(self, manager, block, id_storer, analyzer, printer):
         Thread.__init__(self)
         self.daemon = True
-        self._cleaner = cleaner
+        self._analyzer = analyzer
         self.printer = printer
         self.block = block
         self.id_storer = id_storer
         self.manager = manager
+        self.partial_stats = PartialCollectionStats()
+        self.error = None  # the error that stopped the thread, if any
 
     def _process_line(self, line):
+        """Return the terms of a line."""
         raise NotImplementedError
 
-    def run(self):
-        stemmer = Stemmer()
-        block = self.block
-        id_storer = self.id_storer
-        tokens_amount = 0
-        reversed_index = dict()
-        for doc_id in block.documents:
-            doc_frequency_dict = dict()
-            with open(id_storer.doc_map[doc_id]) as my_file:
-                for line in my_file:
-                    for word in self._process_line(line):
-                        stem_word = stemmer(word)
-                        tokens_amount += 1
-                        doc_frequency_dict[stem_word] = doc_frequency_dict.get(stem_word, 0) + 1
-            doc_frequency_dict = {w: v for w, v in doc_frequency_dict.items() if not self._cleaner.is_common_word(w)}
-            for word in doc_frequency_dict.keys():
-                term_id = id_storer.get_term_id(word)
-                occurrence_list = reversed_index.get(term_id, list())
-                occurrence_list.append((doc_id, doc_frequency_dict[word]))
-                reversed_index[term_id] = occurrence_list
-        for posting_list in reversed_index.values():
-            self.manager.stats.process_posting_list(posting_list)
-        writer = SequentialIndexWriter("indexes/" + block.block_path, len(reversed_index))
-        for term_index in sorted(reversed_index.items(), key=itemgetter(0)):
-            writer.append(term_index)
-        writer.close()
-        self.manager.signal_job_done(self.block.block_path, writer.positions)
+    def parse_document(self, doc_path):
+        """Return the {term: freq} dict of a document."""
+        doc_frequency_dict = dict()
+        with open(doc_path) as my_file:
+            for line in my_file:
+                for term in self._process_line(line):
+                    doc_frequency_dict[term] = doc_frequency_dict.get(term, 0) + 1
+        return doc_frequency_dict
 
+    def parse_document_positions(self, doc_path):
+        """Return the {term: [position, ...]} dict of a document: the position of a term is its rank among the terms
+        of the document, hence common words are not counted."""
+        doc_positions_dict = dict()
+        position = 0
+        with open(doc_path) as my_file:
+            for line in my_file:
+                for term in self._process_line(line):
+                    doc_positions_dict.setdefault(term, list()).append(position)
+                    position += 1
+        return doc_positions_dict
 
-class DefaultBlockParser(AbstractBlockParser):
+    def parse_documents(self, documents, term_positions=None):
+        """Build the inverted index {term: [(doc_id, freq), ...]} of a list of (doc_id, doc_path).
 
-    def _process_line(self, line):
-        return line.split()
+        The statistics of the documents are accumulated in self.partial_stats.
+        :param term_positions: if given, filled with {term: [encoded positions of each posting]}
+        """
+        term_index = dict()
+        for doc_id, doc_path in documents:
+            if term_positions is None:
+                doc_frequency_dict = self.parse_document(doc_path)
+            else:
+                doc_positions_dict = self.parse_document_positions(doc_path)
+                doc_frequency_dict = {term: len(positions) for term, positions in doc_positions_dict.items()}
+                for term, positions in doc_positions_dict.items():
+                    term_positions.setdefault(term, list()).append(encode_positions(positions))
+            self.partial_stats.add_document(doc_id, doc_frequency_dict)
+            for term, freq in doc_frequency_dict.items():
+                occurrence_list = term_index.get(term, list())
+                occurrence_list.append((doc_id, freq))
+                term_index[term] = occurrence_list
+        return term_index
 
+    def run(self):
+        block = self.block
+        doc_map = self.id_storer.doc_map
+        term_positions = dict() if self.manager.positional else None
+        try:
+            term_index = self.parse_documents([(doc_id, doc_map[doc_id]) for doc_id in block.documents],
+                                              term_positions)
+            self.manager.signal_job_done(block.block_path,
+                                         write_block_index(block.block_path, term_index, term_positions))
+        except Exception as error:
+            self.error = error  # raised again by the manager once the threads are joined
+            raise
 
-class Cleaner(object):
 
-    def __init__(self, common_words_file="common_words"):
-        self._common_words = dict()
-        with open(common_words_file) as my_file:
-            for line in my_file:
-                self._common_words[line[:-1]] = True
+class DefaultBlockParser(AbstractBlockParser):
 
-    def is_common_word(self, word):
-        return word in self._common_words
+    def _process_line(self, line):
+        return self._analyzer.analyze(line)
@@ -0,0 +1,249 @@
+import glob
+from os import listdir, remove, replace
+from os.path import exists, isdir
+from shutil import rmtree
+from threading import Thread, Lock
+
+from collection import IDStorer
+from doc_store import DocStore
+from index_construction.compaction import compact_index
+from forward_index import ForwardIndex
+from positional_index import PositionalIndex
+from index_construction.merge import BlockIndexMerger
+from index_construction.parse import DefaultParseManager
+from index_construction.weights import WeightFactory, CollectionStats
+from printer import SegmentPrinter
+from term_dictionary import TermDictionary
+from utils import load_map, load_positions, make_dirs
+
+
+def remove_segments(collection_path):
+    """Remove all the segments of a collection, e.g. after a full build of its index."""
+    segments_dir = "indexes/%s/segments" % collection_path
+    if exists(segments_dir):
+        rmtree(segments_dir)
+
+
+class Segment(object):
+    """An immutable index on a contiguous range of doc ids, with its own positions, term map and statistics."""
+
+    def __init__(self, collection_path, name, first_doc_id, last_doc_id):
+        self.name = name
+        self.path = "%s/segments/%s" % (collection_path, name)  # relative to indexes/, like a collection path
+        self.index_path = "indexes/%s.index" % self.path
+        self.first_doc_id = first_doc_id
+        self.last_doc_id = last_doc_id
+        self.term_map = None
+        self.positions = None
+        self.stats = None
+        self.forward = None  # only written with a forward index
+        self.positional = None  # only written with a positional index
+
+    def __len__(self):
+        return self.last_doc_id - self.first_doc_id + 1
+
+    def open(self):
+        """Load the maps needed to query this segment."""
+        self.term_map = TermDictionary("indexes/" + self.path + "/termdict")
+        self.positions = load_positions("indexes/" + self.path + "/positions")
+        self.stats = CollectionStats.load("indexes/%s/stats" % self.path)
+        if exists("indexes/%s/forward" % self.path):
+            self.forward = ForwardIndex("indexes/%s/forward" % self.path)
+        if exists("indexes/%s/positional" % self.path):
+            self.positional = PositionalIndex("indexes/%s/positional" % self.path)
+        return self
+
+    def load_doc_map(self):
+        return DocStore("indexes/" + self.path + "/docmap")
+
+
+class _SegmentBlock(object):
+
+    def __init__(self, block_path, documents):
+        self.block_path = block_path
+        self.documents = documents
+
+    def __len__(self):
+        return len(self.documents)
+
+
+class _SegmentCollection(object):
+    """The documents of a segment, seen as a Collection by the Parse and Merge steps."""
+
+    def __init__(self, segment, doc_map, live_docs):
+        self.collection_path = segment.path
+        self.id_storer = IDStorer()
+        self.id_storer.update_doc_map(doc_map)  # deleted documents are not parsed, but they keep their doc id
+        self.live_docs = live_docs
+        self.blocks = [_SegmentBlock(segment.path + "/run",
+                                     [doc_id for doc_id in sorted(doc_map) if live_docs.is_live(doc_id)])]
+
+    def store_maps(self):
+        DocStore.write(self.id_storer.doc_map, "indexes/" + self.collection_path + "/docmap")
+        term_map = self.id_storer.term_map
+        TermDictionary.write(sorted(term_map, key=term_map.get), "indexes/" + self.collection_path + "/termdict")
+
+    def __len__(self):
+        return len(self.id_storer.doc_map)
+
+
+class TieredMergePolicy(object):
+    """Merge adjacent segments of the same size tier.
+
+    A segment of less than min_segment_size * merge_factor^(t+1) documents belongs to tier t. As soon as merge_factor
+    adjacent segments belong to the same tier, they are merged into a segment of the next tier: hence each document
+    is only indexed again O(log(n)) times.
+    """
+
+    def __init__(self, merge_factor=10, min_segment_size=100):
+        self.merge_factor = merge_factor
+        self.min_segment_size = min_segment_size
+
+    def get_tier(self, segment):
+        tier = 0
+        while len(segment) >= self.min_segment_size * self.merge_factor ** (tier + 1):
+            tier += 1
+        return tier
+
+    def find_merge(self, segments):
+        """Return the (begin, end) slice of the segments to merge, or None if no merge is needed."""
+        begin = 0
+        for i in range(1, len(segments) + 1):
+            if i == len(segments) or self.get_tier(segments[i]) != self.get_tier(segments[begin]):
+                if i - begin >= self.merge_factor:
+                    return begin, begin + self.merge_factor
+                begin = i
+        return None
+
+
+class SegmentedIndex(object):
+    """The segments added to the index of a collection since its last full build.
+
+    New documents are indexed into small immutable segments instead of rebuilding the whole index, and a background
+    thread compacts the segments according to a merge policy. The live segments are listed in a manifest, which is
+    replaced atomically: files of merged segments are only removed the next time the manifest is opened, since
+    queries may still be reading them.
+
+    A segment stores raw frequencies, weighted at query time with the statistics of the index and of all the live
+    segments, so that its scores compare with the ones of the index.
+    """
+
+    def __init__(self, collection, memory=64 * 2**20, merge_policy=None, verbose=True):
+        self.collection = collection
+        self.memory = memory
+        self.merge_policy = TieredMergePolicy() if merge_policy is None else merge_policy
+        self.printer = SegmentPrinter(verbose)
+        self._dir = "indexes/%s/segments" % collection.collection_path
+        self._lock = Lock()  # guards the list of segments, the manifest and the merge thread
+        self._merger = None
+        self._generation, self._segments = self._load_manifest()
+        self._remove_dead_segments()
+        for segment in self._segments:
+            segment.open()
+            collection.id_storer.update_doc_map(segment.load_doc_map())
+
+    def get_segments(self):
+        """Return the live segments, ordered by doc ids."""
+        return self._segments
+
+    def _load_manifest(self):
+        if not exists(self._dir + "/manifest"):
+            return 0, list()
+        with open(self._dir + "/manifest") as manifest_file:
+            generation = int(manifest_file.readline())
+            segments = list()
+            for line in manifest_file:
+                name, first_doc_id, last_doc_id = line.split()
+                segments.append(Segment(self.collection.collection_path, name, int(first_doc_id), int(last_doc_id)))
+        return generation, segments
+
+    def _save_manifest(self):
+        make_dirs(self._dir + "/manifest")
+        with open(self._dir + "/manifest.tmp", 'w') as manifest_file:
+            manifest_file.write("%i\n" % self._generation)
+            for segment in self._segments:
+                manifest_file.write("%s %i %i\n" % (segment.name, segment.first_doc_id, segment.last_doc_id))
+        replace(self._dir + "/manifest.tmp", self._dir + "/manifest")
+
+    def _remove_dead_segments(self):
+        if not exists(self._dir):
+            return
+        live_names = set([segment.name for segment in self._segments])
+        for file_name in listdir(self._dir):
+            name = file_name[:-len(".index")] if file_name.endswith(".index") else file_name
+            if name not in live_names and name != "manifest":
+                path = self._dir + "/" + file_name
+                rmtree(path) if isdir(path) else remove(path)
+
+    def _new_segment(self, first_doc_id, last_doc_id):
+        with self._lock:
+            self._generation += 1
+            return Segment(self.collection.collection_path, "_%i" % self._generation, first_doc_id, last_doc_id)
+
+    def _build_segment(self, segment, verbose):
+        doc_map = self.collection.id_storer.doc_map
+        collection = _SegmentCollection(segment, {doc_id: doc_map[doc_id]
+                                                  for doc_id in range(segment.first_doc_id, segment.last_doc_id + 1)},
+                                        self.collection.live_docs)
+        settings = load_map("indexes/%s/settings" % self.collection.collection_path, value_type=int)
+        positional = settings.get("positional", 0) == 1
+        forward = settings.get("forward", 0) == 1
+        weighter = WeightFactory.get_weight_function(settings["weight_function_id"], len(segment), segment.first_doc_id)
+        parse_manager = DefaultParseManager(weighter.stats, verbose, positional)
+        parse_manager.parse(collection)
+        # the frequencies are weighted at query time, with the statistics of the index and of all its live segments
+        BlockIndexMerger(collection, parse_manager.block_positions, weighter, self.memory, verbose,
+                         True, positional, forward).merge()
+        collection.store_maps()
+        weighter.stats.save("indexes/%s/stats" % segment.path)
+        return segment.open()
+
+    def add_documents(self, doc_paths):
+        """Index new documents into a new segment and return it."""
+        if len(doc_paths) == 0:
+            return None
+        doc_ids = [self.collection.id_storer.add_doc(doc_path) for doc_path in doc_paths]
+        segment = self._build_segment(self._new_segment(doc_ids[0], doc_ids[-1]), verbose=False)
+        with self._lock:
+            self._segments = self._segments + [segment]
+            self._save_manifest()
+        self.printer.print_segment_added_message(segment.name, len(segment))
+        self.maybe_merge()
+        return segment
+
+    def update(self):
+        """Index the documents of the collection folder that are not indexed yet into a new segment."""
+        indexed_docs = set(self.collection.id_storer.doc_map.values())
+        return self.add_documents(sorted([doc_path for doc_path in glob.glob(self.collection.collection_path + "/*/*")
+                                          if doc_path not in indexed_docs]))
+
+    def compact(self):
+        """Remove the postings of the deleted documents from the segments and return the amount removed."""
+        removed_postings = 0
+        with self._lock:  # the merge thread cannot swap a segment being compacted
+            for segment in self._segments:
+                removed_postings += compact_index(segment.path, self.collection.live_docs, True, self.memory)[2]
+                segment.open()
+        return removed_postings
+
+    def maybe_merge(self):
+        """Start the background merge thread, unless it is already running."""
+        with self._lock:
+            if self._merger is None:
+                self._merger = Thread(target=self._merge_segments, daemon=True)
+                self._merger.start()
+
+    def _merge_segments(self):
+        while True:
+            with self._lock:
+                merge = self.merge_policy.find_merge(self._segments)
+                if merge is None:
+                    self._merger = None
+                    return
+                merged_segments = self._segments[merge[0]:merge[1]]
+            first_doc_id, last_doc_id = merged_segments[0].first_doc_id, merged_segments[-1].last_doc_id
+            segment = self._build_segment(self._new_segment(first_doc_id, last_doc_id), verbose=False)
+            with self._lock:  # segments may have been added meanwhile, but only this thread removes segments
+                begin = self._segments.index(merged_segments[0])
+                self._segments = self._segments[:begin] + [segment] + self._segments[begin + len(merged_segments):]
+                self._save_manifest()
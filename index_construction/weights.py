@@ -1,7 +1,12 @@
-from math import log10, sqrt
-
 # All the weights described here are taken from http://ir.dcs.gla.ac.uk/~ronanc/papers/cumminsChapter.pdf
-from threading import Lock
+from array import array
+from copy import copy
+from os import replace
+
+import numpy as np
+from numpy import log10, sqrt
+
+from utils import load_map, save_map, make_dirs
 
 
 class WeightFactory(object):
@@ -10,8 +15,14 @@ class WeightFactory(object):
     weightClasses = list()
 
     @staticmethod
-    def get_weight_function(weight_function_id, collection_size):
-        return WeightFactory.weightClasses[weight_function_id](weight_function_id, collection_size)
+    def get_weight_function(weight_function_id, collection_size, first_doc_id=1, stats=None):
+        """
+        :param stats: the CollectionStats to weight with, e.g. loaded along with a raw-frequency index
+        """
+        weighter = WeightFactory.weightClasses[weight_function_id](weight_function_id, collection_size, first_doc_id)
+        if stats is not None:
+            weighter.stats = stats
+        return weighter
 
 
 class Weighter(object):
@@ -19,14 +30,15 @@ class Weighter(object):
 
     Any implementation of a weight function must inherit from this class and be decorated with the declare_subclass
     method in order to be declared to the WeightFactory (see examples below).
+    Weight functions must only use NumPy operations so that they can be applied to a whole posting list at once.
     """
 
     @classmethod
     def declare_weighter(cls):
         WeightFactory.weightClasses.append(cls)
 
-    def __init__(self, weight_id, collection_size):
-        self.stats = CollectionStats(collection_size)
+    def __init__(self, weight_id, collection_size, first_doc_id=1):
+        self.stats = CollectionStats(collection_size, first_doc_id)
         self.weight_function_id = weight_id
 
     def weight(self, doc_id, *args):
@@ -37,6 +49,22 @@ class Weighter(object):
         """
         return self._weight_function(*(list(args) + self._get_stat_args(doc_id)))
 
+    def weight_posting_list(self, doc_ids, tfs, *args):
+        """Compute the weights of a whole posting list at once.
+
+        doc_ids and tfs are NumPy arrays, *args is the rest of the data from the index (usually df).
+        Return a NumPy array of weights.
+        """
+        return self._weight_function(*([tfs] + list(args) + self._get_stat_args(doc_ids)))
+
+    def weight_frequencies(self, doc_ids, tfs, df, cf):
+        """Compute the weights of a whole posting list of frequencies at once, given the df and the cf of its term."""
+        return self.weight_posting_list(doc_ids, tfs, *self._get_term_args(df, cf))
+
+    def _get_term_args(self, df, cf):
+        """Select the statistics of a term needed to compute a weight: most weight functions only need the df."""
+        return [df]
+
     def _weight_function(self, *args):
         # This method is meant to be abstract. Any extension of the Weighter class must implement it!
         raise NotImplementedError
@@ -75,7 +103,7 @@ class NormalizedTfIdf(Weighter):
 class NormalizedFrequency(Weighter):
 
     def _weight_function(self, tf, df, max_freq):
-        return tf / float(max_freq)
+        return tf / max_freq
 
     def _get_stat_args(self, doc_id):
         return [self.stats.get_doc_max_freq(doc_id)]
@@ -131,6 +159,9 @@ class EvolutionaryLearnedScheme(Weighter):
         idf_es = sqrt(cf*cf*cf*collection_size / float(df*df*df*df))
         return tf_es*idf_es
 
+    def _get_term_args(self, df, cf):
+        return [df, cf]
+
     def _get_stat_args(self, d_id):
         return [self.stats.get_collection_size(), self.stats.get_doc_length(d_id), self.stats.get_average_doc_length()]
 
@@ -140,8 +171,8 @@ class DivergenceFromRandomness(Weighter):
 
     def _weight_function(self, tf, df, collection_size, doc_length, average_length):
         """Divergence From Randomness."""
-        tf_dfr = tf * log10(1 + average_length / float(doc_length)) \
-                 / (1 + tf*log10(1 + average_length / float(doc_length)))
+        tf_dfr = tf * log10(1 + average_length / doc_length) \
+                 / (1 + tf*log10(1 + average_length / doc_length))
         idf_dfr = log10((collection_size + 1) / (df + 0.5))
         return tf_dfr * idf_dfr
 
@@ -162,28 +193,108 @@ class AxiomaticScheme(Weighter):
         return [self.stats.get_collection_size(), self.stats.get_doc_length(d_id), self.stats.get_average_doc_length()]
 
 
+class PartialCollectionStats(object):
+    """Statistics on a subset of the documents of the collection.
+
+    Each parser accumulates its own partial statistics, which are merged into the CollectionStats at the end of the
+    Parse step: no lock is needed.
+    """
+
+    def __init__(self):
+        self.doc_ids = array('q')
+        self.doc_lengths = array('q')
+        self.doc_max_freqs = array('q')
+        self.doc_term_counts = array('q')
+
+    def add_document(self, doc_id, doc_frequency_dict):
+        """Add the {term: freq} dict of a document."""
+        self.doc_ids.append(doc_id)
+        self.doc_lengths.append(sum(doc_frequency_dict.values()))
+        self.doc_max_freqs.append(max(doc_frequency_dict.values(), default=0))
+        self.doc_term_counts.append(len(doc_frequency_dict))
+
+
 class CollectionStats(object):
-    """Store statistics on the processed collection."""
+    """Store statistics on the processed collection.
+
+    Doc ids are dense (see IDStorer.add_doc): the statistics of the documents are stored in arrays indexed by doc id.
+    The doc ids of a collection (or of a segment of it, see segments.py) range from first_doc_id to
+    first_doc_id + collection_size - 1, deleted documents included: collection_size and average_doc_length only account
+    for the live documents (see remove_deleted_documents), whereas the arrays cover the whole range.
+
+    The cf of each term is also kept, indexed by term id, since the frequencies of a weighted index are not stored.
+    """
+
+    _ARRAYS = ["doc_lengths", "doc_max_freqs", "collection_frequencies"]
 
-    def __init__(self, collection_size):
-        self.docs_stats = dict()
+    def __init__(self, collection_size, first_doc_id=1):
+        self.first_doc_id = first_doc_id
+        self.doc_lengths = np.zeros(collection_size, dtype=np.int32)
+        self.doc_max_freqs = np.zeros(collection_size, dtype=np.int32)
+        self.doc_term_counts = np.zeros(collection_size, dtype=np.int32)  # the size of the vector of each document
+        self.collection_frequencies = np.zeros(0, dtype=np.int64)  # the cf of term_id at term_id - 1, once merged
         self.average_doc_length = 0
         self.collection_size = collection_size
-        self.lock = Lock()
 
     def process_posting_list(self, posting_list):
         """Update the statistics with a new posting list."""
-        with self.lock:
-            for doc_id, freq in posting_list:
-                length, max_freq = self.docs_stats.get(doc_id, (0, 0))
-                length += freq
-                self.average_doc_length += freq
-                if freq > max_freq:
-                    max_freq = freq
-                self.docs_stats[doc_id] = length, max_freq
-
-    def signal_end_of_merge(self):
-        self.average_doc_length /= float(self.collection_size)
+        doc_ids, freqs = np.array(posting_list, dtype=np.int64).reshape(-1, 2).T
+        np.add.at(self.doc_lengths, doc_ids - self.first_doc_id, freqs)
+        np.maximum.at(self.doc_max_freqs, doc_ids - self.first_doc_id, freqs)
+        np.add.at(self.doc_term_counts, doc_ids - self.first_doc_id, 1)
+        self.average_doc_length += int(freqs.sum())
+
+    def merge(self, partial_stats):
+        """Merge the PartialCollectionStats computed by a parser."""
+        doc_ids = np.frombuffer(partial_stats.doc_ids, dtype=np.int64) - self.first_doc_id
+        doc_lengths = np.frombuffer(partial_stats.doc_lengths, dtype=np.int64)
+        self.doc_lengths[doc_ids] = doc_lengths
+        self.doc_max_freqs[doc_ids] = np.frombuffer(partial_stats.doc_max_freqs, dtype=np.int64)
+        self.doc_term_counts[doc_ids] = np.frombuffer(partial_stats.doc_term_counts, dtype=np.int64)
+        self.average_doc_length += int(doc_lengths.sum())
+
+    def signal_end_of_merge(self, live_docs=None):
+        """Turn the sum of the document lengths into their average, over the live documents only if given."""
+        if live_docs is None:
+            self.average_doc_length /= float(self.collection_size)
+        else:
+            self.remove_deleted_documents(live_docs)
+
+    def remove_deleted_documents(self, live_docs):
+        """Compute the collection size and the average document length again, over the live documents only."""
+        doc_lengths = live_docs.filter(np.arange(len(self.doc_lengths)) + self.first_doc_id, self.doc_lengths)[1]
+        self.collection_size = len(doc_lengths)
+        self.average_doc_length = int(doc_lengths.sum(dtype=np.int64)) / float(max(self.collection_size, 1))
+
+    def within(self, collection_size, average_doc_length):
+        """
+        Return a copy of the statistics, sharing their arrays, for documents weighted as a part of a larger collection,
+        e.g. a segment weighted along the index and the other segments.
+        """
+        stats = copy(self)
+        stats.collection_size = collection_size
+        stats.average_doc_length = average_doc_length
+        return stats
+
+    def save(self, dir_path):
+        """Save the statistics, replacing each array at once since a query parser may still map the previous one."""
+        make_dirs(dir_path + "/summary")
+        for name in CollectionStats._ARRAYS:
+            np.save("%s/%s.tmp.npy" % (dir_path, name), getattr(self, name))
+            replace("%s/%s.tmp.npy" % (dir_path, name), "%s/%s.npy" % (dir_path, name))
+        save_map({"first_doc_id": self.first_doc_id, "collection_size": self.collection_size,
+                  "average_doc_length": self.average_doc_length}, dir_path + "/summary")
+
+    @staticmethod
+    def load(dir_path):
+        """Load the statistics saved with an index: the arrays are mapped in memory, not read."""
+        summary = load_map(dir_path + "/summary")
+        stats = CollectionStats(0, int(summary["first_doc_id"]))
+        for name in CollectionStats._ARRAYS:
+            setattr(stats, name, np.load("%s/%s.npy" % (dir_path, name), mmap_mode='r'))
+        stats.collection_size = int(summary["collection_size"])
+        stats.average_doc_length = float(summary["average_doc_length"])
+        return stats
 
     def get_collection_size(self):
         return self.collection_size
@@ -192,7 +303,9 @@ class CollectionStats(object):
         return self.average_doc_length
 
     def get_doc_length(self, doc_id):
-        return self.docs_stats[doc_id][0]
+        """Return the length of a document, or a NumPy array of lengths for a NumPy array of doc ids."""
+        return self.doc_lengths[doc_id - self.first_doc_id]
 
     def get_doc_max_freq(self, doc_id):
-        return self.docs_stats[doc_id][1]
+        """Return the max frequency of a document, or a NumPy array of them for a NumPy array of doc ids."""
+        return self.doc_max_freqs[doc_id - self.first_doc_id]
@@ -1,29 +1,58 @@
 import argparse
 import textwrap
 from argparse import RawTextHelpFormatter
+from multiprocessing import cpu_count
+from os.path import exists
 
 from collection import Collection
 from evaluation.main import run_test
-from index_construction.main import build_index
+from index_construction.main import build_index, compact, switch_weight_function
+from index_construction.segments import SegmentedIndex
 from index_construction.weights import WeightFactory
-from utils import load_map, load_positions
+from utils import load_positions
 from queries.boolean_queries import BooleanQueryParser
+from queries.feedback import Rocchio
 from queries.vector_queries import VectorQueryParser
 
 
-def run(collection_name, force_new_index, weight_function_id, start_evaluation, memory, boolean):
+def run(collection_name, force_new_index, weight_function_id, start_evaluation, memory, boolean, processes=0,
+        run_memory=None, update=False, deleted_docs=None, compaction=False, raw_frequencies=False, feedback_docs=None,
+        positional=False, top_k=None, cache_memory=None, postings_cache_memory=None, pinned_terms=0, forward=False):
     collection_path = collection_name + "-data"
     if start_evaluation:
         run_test(collection_path, "queries/query.text", "queries/qrels.text")
     else:
         c = Collection(collection_path, verbose=True)
+        if force_new_index and raw_frequencies and exists("indexes/%s/settings" % c.collection_path) \
+                and switch_weight_function(c, weight_function_id):
+            print("Weight function #%i applied at query time" % weight_function_id)
+            force_new_index = False
         if force_new_index:
-            positions = build_index(c, weight_function_id, verbose=True, memory=memory)
+            positions = build_index(c, weight_function_id, verbose=True, memory=memory * 2**20, processes=processes,
+                                    run_memory=None if run_memory is None else run_memory * 2**20,
+                                    raw_frequencies=raw_frequencies, positional=positional, forward=forward)
         else:
-            c.id_storer.term_map = load_map("indexes/" + c.collection_path + "/termmap", value_type=int)
+            c.load_maps()
             positions = load_positions("indexes/" + c.collection_path + "/positions")
-        parser_builder = BooleanQueryParser if boolean else VectorQueryParser
-        runner = parser_builder(c, "indexes/%s.index" % c.collection_path, positions, verbose=True)
+        segments = SegmentedIndex(c, memory=memory * 2**20)
+        if update:
+            segments.update()
+        if deleted_docs is not None:
+            print("%i documents deleted" % c.delete_documents(deleted_docs))
+        if compaction:
+            positions = compact(c, segments, memory=memory * 2**20)
+        cache_memory = None if cache_memory is None else cache_memory * 2**20
+        postings_cache_memory = None if postings_cache_memory is None else postings_cache_memory * 2**20
+        if boolean:
+            runner = BooleanQueryParser(c, "indexes/%s.index" % c.collection_path, positions, verbose=True,
+                                        segments=segments, cache_memory=cache_memory,
+                                        postings_cache_memory=postings_cache_memory, pinned_terms=pinned_terms)
+        else:
+            runner = VectorQueryParser(c, "indexes/%s.index" % c.collection_path, positions, verbose=True,
+                                       segments=segments,
+                                       feedback=None if feedback_docs is None else Rocchio(feedback_docs),
+                                       top_k=top_k, cache_memory=cache_memory,
+                                       postings_cache_memory=postings_cache_memory, pinned_terms=pinned_terms)
         while True:
                 runner.execute_query(input("Enter your query: "))
 
@@ -35,7 +64,38 @@ if __name__ == '__main__':
     help_str = "".join(["%i: %s\n" % (i, weighter.__name__) for i, weighter in enumerate(WeightFactory.weightClasses)])
     arg_parser.add_argument('-w', '--weight', default=None, type=int, help=textwrap.dedent(help_str))
     arg_parser.add_argument('-e', '--evaluate', help="add this flag to launch engine evaluation", action="store_true")
-    arg_parser.add_argument('-m', '--memory', default=2200, type=int, help="set memory limitations")
+    arg_parser.add_argument('-m', '--memory', default=64, type=int,
+                            help="set memory limitations of the Merge step IO buffers (in MB)")
+    arg_parser.add_argument('-p', '--processes', default=0, const=cpu_count(), nargs='?', type=int,
+                            help="parse blocks in a pool of worker processes (default: one per CPU)")
+    arg_parser.add_argument('-s', '--spimi', default=None, type=int,
+                            help="ignore blocks and flush a run every SPIMI MB of in-memory index")
+    arg_parser.add_argument('-u', '--update', action="store_true",
+                            help="index the documents added to the collection since the last build into a new segment")
+    arg_parser.add_argument('-d', '--delete', default=None, nargs='+', metavar="DOC_PATH",
+                            help="remove documents from the results (their postings are kept until a compaction)")
+    arg_parser.add_argument('-c', '--compact', action="store_true",
+                            help="rewrite the index without the postings of the deleted documents")
+    arg_parser.add_argument('-r', '--raw', action="store_true",
+                            help="with -w, store raw frequencies in the index and weight them at query time:\n"
+                                 "the weight function of such an index changes without building it again")
+    arg_parser.add_argument('-f', '--feedback', default=None, const=10, nargs='?', type=int, metavar="DOCS",
+                            help="expand vector queries with the vectors of their DOCS top documents (default: 10)")
+    arg_parser.add_argument('-P', '--positional', action="store_true",
+                            help="with -w, store the positions of the terms in the documents, for phrase\n"
+                                 "(\"foo bar\") and proximity (foo NEAR/3 bar) queries")
+    arg_parser.add_argument('-F', '--forward', action="store_true",
+                            help="with -w, store the vector of each document in a forward index, for query\n"
+                                 "expansion (-f)")
+    arg_parser.add_argument('-k', '--top', default=None, type=int,
+                            help="only retrieve the TOP best documents of vector queries")
+    arg_parser.add_argument('-C', '--cache', default=None, const=16, nargs='?', type=int, metavar="MB",
+                            help="cache the results of the last queries within MB of memory (default: 16)")
+    arg_parser.add_argument('-L', '--postings-cache', default=None, const=64, nargs='?', type=int, metavar="MB",
+                            help="cache the decoded posting lists of the index within MB of memory (default: 64)")
+    arg_parser.add_argument('-n', '--pin', default=0, type=int, metavar="TERMS",
+                            help="with -L, decode the posting lists of the TERMS most frequent terms at startup\n"
+                                 "and keep them in the cache")
     args = arg_parser.parse_args()
     refresh = False
     if args.collection not in ['cs276', 'cacm']:
@@ -49,4 +109,36 @@ if __name__ == '__main__':
     if args.evaluate and args.collection == 'cs276':
         print("\tEngine evaluation is only supported for the cacm collection")
         exit(2)
-    run(args.collection, refresh, args.weight, args.evaluate, args.memory, args.boolean)
+    if args.processes < 0:
+        print("\tThe amount of worker processes must be positive")
+        exit(2)
+    if args.spimi is not None and (args.spimi <= 0 or args.processes != 0):
+        print("\tThe SPIMI run size must be positive and cannot be combined with worker processes")
+        exit(2)
+    if args.feedback is not None and (args.feedback <= 0 or args.boolean):
+        print("\tQuery expansion needs a positive amount of documents and only applies to vector queries")
+        exit(2)
+    if args.top is not None and (args.top <= 0 or args.boolean):
+        print("\tThe amount of top documents must be positive and only applies to vector queries")
+        exit(2)
+    if args.cache is not None and args.cache <= 0:
+        print("\tThe memory of the result cache must be positive")
+        exit(2)
+    if args.postings_cache is not None and args.postings_cache <= 0:
+        print("\tThe memory of the posting list cache must be positive")
+        exit(2)
+    if args.pin < 0 or (args.pin > 0 and args.postings_cache is None):
+        print("\tThe amount of pinned terms must be positive and needs a posting list cache (-L)")
+        exit(2)
+    if args.positional and args.weight is None:
+        print("\tA positional index is built with a weight function (-w)")
+        exit(2)
+    if args.forward and args.weight is None:
+        print("\tA forward index is built with a weight function (-w)")
+        exit(2)
+    if args.raw and args.weight is None:
+        print("\tA raw-frequency index needs a weight function (-w) to apply at query time")
+        exit(2)
+    run(args.collection, refresh, args.weight, args.evaluate, args.memory, args.boolean, args.processes, args.spimi,
+        args.update, args.delete, args.compact, args.raw, args.feedback, args.positional, args.top, args.cache,
+        args.postings_cache, args.pin, args.forward)
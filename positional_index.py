@@ -0,0 +1,64 @@
+import mmap
+from os import replace
+
+import numpy as np
+
+from utils import make_dirs, load_positions, save_positions, positions_to_bin, decode_positions
+
+_MAGIC = b"TSP1"
+OFFSETS_SUFFIX = "_offsets"  # the offset of the positions of each term is stored in <positional_index_path>_offsets
+
+
+class PositionalIndexWriter(object):
+    """
+    Write the positions of the terms of an index in the documents of their posting lists, one term at a time, in the
+    order of the term ids.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.offsets = list()
+        make_dirs(file_path)
+        self._file = open(file_path + ".tmp", 'wb')
+        self._file.write(_MAGIC)
+
+    def append(self, tfs, gaps_bin):
+        """
+        Add the positions of a term.
+        :param tfs: the amount of positions of the term in each document of its posting list
+        :param gaps_bin: the positions, encoded with utils.encode_positions
+        """
+        self.offsets.append(self._file.tell())
+        self._file.write(positions_to_bin(tfs, gaps_bin))
+
+    def close(self):
+        self._file.close()
+        replace(self.file_path + ".tmp", self.file_path)  # a query parser may still map the previous file
+        save_positions(self.offsets, self.file_path + OFFSETS_SUFFIX)
+
+
+class PositionalIndex(object):
+    """
+    The positions of the terms of an index in the documents of their posting lists, read through mmap.
+
+    The positions of a term are stored like its posting list: they are found from its term id, then the positions in a
+    document from the rank of the document in the posting list (see utils.positions_to_bin).
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as positional_file:
+            self._data = memoryview(mmap.mmap(positional_file.fileno(), 0, access=mmap.ACCESS_READ))
+        if self._data[:len(_MAGIC)] != _MAGIC:
+            raise ValueError("%s is not a positional index: build the index again" % file_path)
+        self._offsets = np.asarray(load_positions(file_path + OFFSETS_SUFFIX), dtype=np.int64)
+
+    def get(self, term_id, ranks):
+        """
+        Return the positions of a term in some documents of its posting list.
+        :param ranks: the increasing ranks of the documents in the posting list, deleted documents included
+        :return: (index of the document in ranks, position) of each position, as NumPy arrays
+        """
+        index = term_id - 1
+        end = len(self._data) if index == len(self._offsets) - 1 else int(self._offsets[index + 1])
+        return decode_positions(self._data[int(self._offsets[index]):end], ranks)
@@ -16,6 +16,17 @@ class ParsePrinter(ConsolePrinter):
     def print_block_parse_end_message(self, blocks_left):
         self._validate_print("\tIn progress:  %i blocks parsed" % blocks_left)
 
+    def print_spimi_parse_start_message(self, nb_docs, run_memory):
+        self._validate_print("Starting single-pass parse of %i documents (runs of %.1f MB)" % (nb_docs, run_memory / 2**20))
+
+    def print_stemmer_cache_message(self, hits, misses):
+        if hits + misses > 0:
+            self._validate_print("\tStemmer cache: %i hits, %i misses (%.1f%% hit rate)"
+                                 % (hits, misses, 100.0 * hits / (hits + misses)))
+
+    def print_run_flush_message(self, nb_runs, nb_docs):
+        self._validate_print("\tIn progress:  %i runs flushed, %i documents parsed" % (nb_runs, nb_docs))
+
 
 class MergePrinter(ConsolePrinter):
 
@@ -28,19 +39,28 @@ class MergePrinter(ConsolePrinter):
     def print_end_of_merge_message(self, counter):
         self._validate_print("Merging ended: %i unique terms found" % counter)
 
+    def print_forward_index_message(self, time, size):
+        self._validate_print("\tForward index written in %.2f sec (%.1f MB)" % (time, size / 2**20))
+
+
+class SegmentPrinter(ConsolePrinter):
+
+    def print_segment_added_message(self, name, nb_docs):
+        self._validate_print("Segment %s added: %i new documents indexed" % (name, nb_docs))
+
 
 class QueryParserPrinter(ConsolePrinter):
 
     def print_results(self, results, time):
-        counter = 0
+        """Print the pages of a Results cursor, one at a time: the next one is only resolved if asked for."""
         if self.verbose:
             print("%i document%s found in %.3f seconds" % (len(results), "s" if len(results) > 1 else "", time))
-            while counter * 10 < len(results):
-                print("Printing result page [%i/%i]" % (counter+1, len(results)//10 + (1 if len(results) % 10 != 0 else 0)))
-                for i, doc in enumerate(results[10*counter:min(10*(counter+1), len(results))]):
-                    print("\t%i. [%.5f]: %s" % (10*counter + i+1, doc[1], doc[0]))
-                counter += 1
-                if counter * 10 < len(results):
+            pages_amount = results.pages_amount()
+            for counter in range(pages_amount):
+                print("Printing result page [%i/%i]" % (counter+1, pages_amount))
+                for i, doc in enumerate(results.next()):
+                    print("\t%i. [%.5f]: %s" % (results.capacity*counter + i+1, doc[1], doc[0]))
+                if counter + 1 < pages_amount:
                     go_next = '?'
                     while len(go_next) == 0 or go_next[0] not in ['y', 'n']:
                         go_next = input("Go to next page? (y/n) ")
@@ -51,13 +71,34 @@ class QueryParserPrinter(ConsolePrinter):
                     print("End of results.")
             print()
 
+    def print_cache_message(self, cache, name="Result cache"):
+        if cache is not None and cache.hits + cache.misses > 0:
+            self._validate_print("\t%s: %i hits, %i misses (%.1f%% hit rate), %i entries in %.1f kB"
+                                 % (name, cache.hits, cache.misses, 100.0 * cache.hit_rate(), len(cache),
+                                    cache.size() / 2**10))
+
+    def print_pinned_terms_message(self, amount, cache):
+        self._validate_print("%i posting lists pinned in the cache (%.1f kB)" % (amount, cache.size() / 2**10))
+
+    def print_missing_positions_message(self):
+        self._validate_print("\tThe index has no positions: build it again with -P to run phrase and NEAR queries")
+
+    def print_missing_forward_index_message(self):
+        self._validate_print("\tThe index has no forward index: build it again with -F to expand queries")
+
+    def print_expanded_query(self, expanded_terms):
+        if len(expanded_terms) > 0:
+            self._validate_print("\tQuery expanded with: %s" % " ".join(expanded_terms))
+
     def print_query_constraints(self):
         message = "**********" \
                   "\nBoolean queries must respect the following structure:" \
                   "\n\t- the query is written in CNF, i.e. a conjunction of disjunctions " \
                   "\n\t- disjunctions are separated with the && (AND) operator " \
                   "\n\t- a disjunction is a list of terms separated with the || (OR) operator and surrounded with parenthesis " \
-                  "Two extra rules ensure that queries are well-defined: " \
+                  "\n\t- with a positional index (-P), a term can be a phrase (\"foo bar\") or a proximity query " \
+                  "(foo NEAR/3 bar) " \
+                  "\nTwo extra rules ensure that queries are well-defined: " \
                   "\n\t- the NOT operator can only apply to a disjunction (and not to a term) " \
                   "\n\t\t--> (foobar) && !(foo || bar) is well-defined " \
                   "\n\t\t--> (foobar) && (!foo || bar) is not (cf. end of doc) " \
@@ -1,24 +1,146 @@
-import heapq
-import operator
-from threading import Thread
-import time
+from bisect import bisect_left
+from collections import namedtuple
+from functools import partial, reduce
+import mmap
+import os
+from os.path import exists
+import re
 
-from utils import bin_to_term_index
+import numpy as np
+
+from analyzer import Analyzer, alphanumeric_tokenizer
+from forward_index import ForwardIndex
+from index_construction.weights import WeightFactory, CollectionStats
+from positional_index import PositionalIndex
+from utils import decode_posting_list, decode_posting_list_length, decode_max_weight, decode_chunks, decode_chunk, \
+    check_index_header, load_map, POSTINGS_PER_CHUNK
 from printer import QueryParserPrinter
+from queries.cache import LRUCache, QueryResultCache
+from term_dictionary import TermDictionary
+
+
+# a phrase ("stanford university") or a proximity query (stanford NEAR/3 university)
+POSITIONAL_EXPRESSION = re.compile(r'"([^"]*)"|(\S+) NEAR/(\d+) (\S+)')
+
+
+def _intersect_sorted(values, sorted_values):
+    """Return the values found in sorted_values, both being increasing NumPy arrays, without sorting them again."""
+    if len(sorted_values) == 0:
+        return sorted_values
+    return values[sorted_values[np.minimum(np.searchsorted(sorted_values, values), len(sorted_values) - 1)] == values]
+
+
+def _documents(keys):
+    """Return the distinct documents of increasing (document << 32 | position) keys."""
+    documents = keys >> 32
+    return documents[np.concatenate(([True], documents[1:] != documents[:-1]))] if len(documents) > 0 else documents
+
+
+def _match_phrase(keys):
+    """
+    Return the documents where the terms follow each other.
+    :param keys: the (document << 32 | position) of each position of each term of the phrase, as increasing NumPy arrays
+    """
+    matches = keys[0]
+    for offset, term_keys in enumerate(keys[1:], 1):
+        matches = _intersect_sorted(matches, term_keys - offset)
+    return _documents(matches)
+
+
+def _match_near(keys, distance):
+    """Return the documents where each term is at most distance terms away from the next one, in any order."""
+    matches = None
+    for first_keys, second_keys in zip(keys, keys[1:]):
+        indexes = np.searchsorted(second_keys, first_keys)
+        following = second_keys[np.minimum(indexes, len(second_keys) - 1)]
+        preceding = second_keys[np.maximum(indexes - 1, 0)]
+        close = (np.abs(following - first_keys) <= distance) | (np.abs(first_keys - preceding) <= distance)
+        documents = _documents(first_keys[close])
+        matches = documents if matches is None else _intersect_sorted(matches, documents)
+    return matches
+
+
+def _weight_frequencies(weighter, doc_ids, tfs, df, cf):
+    """Weight frequencies read from a raw-frequency index as the Merge step would, rounding weights to 4-byte floats."""
+    return weighter.weight_frequencies(doc_ids, tfs.astype(np.int64), df, cf).astype('=f4')
+
+
+# the index or a segment, with its statistics, its Weighter (None if it stores weights), its PositionalIndex and its
+# (TermDictionary, ForwardIndex) if any
+_Source = namedtuple('_Source', ['term_map', 'index_reader', 'stats', 'weighter', 'positional', 'forward'])
 
 
 class _CollectionIndexReader(object):
     """
     A Read interface for an index file.
+
+    The index file is mapped in memory once: the weights of a posting list are a NumPy view on the mapped file, and only
+    its doc ids are decoded. The upper bounds of the weights of a refined posting list are read without decoding it.
+
+    With a cache (see cache.LRUCache), the decoded refined posting lists are kept within a memory budget, in which only
+    their doc ids count, and the posting lists of the most frequent terms may be pinned in it.
     """
 
-    def __init__(self, index_path, positions):
+    def __init__(self, index_path, positions, cache=None):
         """
         :param index_path: the path to the index file
-        :param positions: a deque of the positions in the index
+        :param positions: the positions of the posting lists in the index, ordered by term id, e.g. a mapped int64 array
+        :param cache: the LRUCache of the decoded refined posting lists, keyed by term id, if any
         """
         self._index_path = index_path
-        self._positions = positions
+        self._positions = np.asarray(positions, dtype=np.int64)  # a plain view on a mapped positions file, not a copy
+        self.cache = cache
+        with open(index_path, 'rb') as index_file:
+            check_index_header(index_file)
+            self._index = memoryview(mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def _raw_posting_list(self, term_id):
+        index = term_id - 1
+        start = int(self._positions[index])
+        end = len(self._index) if index == len(self._positions) - 1 else int(self._positions[index + 1])
+        return self._index[start:end]
+
+    @staticmethod
+    def _postings_size(postings):
+        """Return the amount of bytes of decoded postings, the views on the mapped index file not included."""
+        return sum([array.nbytes for array in postings if array.flags.owndata])
+
+    def decode(self, term_id):
+        """
+        Get the refined posting list of a term id, from the cache if any.
+        :return: (doc_ids, weights or frequencies) NumPy arrays, which must not be modified
+        """
+        if self.cache is None:
+            return decode_posting_list(self._raw_posting_list(term_id), refined=True)[1:]
+        postings = self.cache.get(term_id)
+        if postings is None:
+            postings = decode_posting_list(self._raw_posting_list(term_id), refined=True)[1:]
+            self.cache.put(term_id, postings, self._postings_size(postings))
+        return postings
+
+    def is_cached(self, term_id):
+        return self.cache is not None and term_id in self.cache
+
+    def pin_frequent_terms(self, amount):
+        """
+        Pin the posting lists of the amount most frequent terms in the cache, as long as they fit.
+
+        The terms are selected at once by the size of their binary posting lists, read from the positions: it grows with
+        the document frequency, which is not read from each posting list.
+        :return: the amount of posting lists pinned
+        """
+        sizes = np.diff(self._positions, append=len(self._index))
+        if amount < len(sizes):
+            term_indexes = np.argpartition(-sizes, amount)[:amount]
+        else:
+            term_indexes = np.arange(len(sizes))
+        pinned = 0
+        for term_id in (term_indexes[np.argsort(-sizes[term_indexes], kind='stable')] + 1).tolist():
+            postings = decode_posting_list(self._raw_posting_list(term_id), refined=True)[1:]
+            if not self.cache.pin(term_id, postings, self._postings_size(postings)):
+                break
+            pinned += 1
+        return pinned
 
     def read(self, term_ids, refined=False):
         """
@@ -26,89 +148,512 @@ class _CollectionIndexReader(object):
         :type term_ids: list of int
         :param term_ids:
         :param refined:
-        :return: a list of posting lists
-        """
-        result = dict()
-        with open(self._index_path, 'rb') as index_file:
-            for term_id in term_ids:
-                try:
-                    index = term_id - 1
-                    index_file.seek(self._positions[index])
-                    if index == len(self._positions) - 1:
-                        size = -1
-                    else:
-                        size = self._positions[index + 1] - self._positions[index]
-                    result[term_id] = bin_to_term_index(index_file.read(size), refined=refined)[1]
-                except KeyError:
-                    result[term_id] = list()
-        return result
-
-
-class Results(Thread):
-
-    def __init__(self, results, id_storer, capacity=10):
-        Thread.__init__(self, daemon=True)
-        self._status = False  # True iff self._results is completely sorted
-        self._raw_results = results
+        :return: {term_id: (doc_ids, weights or frequencies)}, as NumPy arrays
+        """
+        if refined:
+            return {term_id: self.decode(term_id) for term_id in term_ids}
+        return {term_id: decode_posting_list(self._raw_posting_list(term_id), refined=refined)[1:]
+                for term_id in term_ids}
+
+    def read_binaries(self, term_ids):
+        """
+        Get the binary posting lists of a list of term ids, as views on the mapped index file.
+        :return: {term_id: memoryview}
+        """
+        return {term_id: self._raw_posting_list(term_id) for term_id in term_ids}
+
+    def read_max_weights(self, term_ids):
+        """
+        Get the upper bound of the weights of the posting lists of a list of term ids, without decoding them.
+        :return: {term_id: max weight}
+        """
+        return {term_id: decode_max_weight(self._raw_posting_list(term_id)) for term_id in term_ids}
+
+    def read_chunks(self, term_ids):
+        """
+        Get the upper bounds of the weights of the posting lists of a list of term ids, per chunk of postings.
+        :return: {term_id: (last doc id of each chunk, max weight of each chunk)}, as NumPy arrays
+        """
+        return {term_id: decode_chunks(self._raw_posting_list(term_id)) for term_id in term_ids}
+
+
+class PostingCursor(object):
+    """
+    A cursor on a refined posting list, split between the index and its segments, that only stops on live documents.
+
+    The cursor moves forward to a target doc id by galloping on the last doc ids of the chunks of each binary posting
+    list (see utils.decode_chunks): only the chunk holding the target is decoded, or sliced from the decoded posting
+    list if it is cached.
+    """
+
+    def __init__(self, raw_bins, live_docs, weighters=None, decoders=None, decoded=None, term_statistics=None):
+        """
+        :param raw_bins: the binary posting lists of a term in the index and in its segments, ordered by doc ids
+        :param weighters: the Weighter of each binary posting list of raw frequencies, None otherwise
+        :param decoders: a function () -> (doc_ids, weights or frequencies) decoding each binary posting list at once,
+        e.g. through the cache of its index reader, None to decode them in place
+        :param decoded: the (doc_ids, weights or frequencies) of each binary posting list if they are at hand, e.g.
+        cached, None otherwise
+        :param term_statistics: the (df, cf) of the term over the index and its segments, to weight frequencies with
+        """
+        self._raw_bins = raw_bins
+        self._live_docs = live_docs
+        self._weighters = [None] * len(raw_bins) if weighters is None else weighters
+        self._decoders = [lambda raw_bin=raw_bin: decode_posting_list(raw_bin, refined=True)[1:]
+                          for raw_bin in raw_bins] if decoders is None else decoders
+        self._decoded = [None] * len(raw_bins) if decoded is None else decoded
+        self._term_statistics = term_statistics
+        self._length = sum([decode_posting_list_length(raw_bin) for raw_bin in raw_bins])
+        self._part = -1
+        self._next_part()
+        self.doc_id = None
+
+    def __len__(self):
+        """Return the amount of postings of the posting list, deleted documents included."""
+        return self._length
+
+    @property
+    def weight(self):
+        """Return the weight of the current posting, or None. The frequencies of a chunk are weighted on demand."""
+        if self.doc_id is None:
+            return None
+        if self._weights is None:
+            doc_ids, tfs = self._decode_chunk()
+            self._weights = _weight_frequencies(self._weighters[self._part], doc_ids, tfs, *self._term_statistics)
+        return float(self._weights[self._index])
+
+    def _next_part(self):
+        self._part += 1
+        self._chunk = 0
+        self._doc_ids, self._weights, self._index = None, None, 0
+        if self._part < len(self._raw_bins):
+            self._last_doc_ids = decode_chunks(self._raw_bins[self._part])[0].tolist()
+
+    def _decode_chunk(self):
+        """Return the (doc_ids, weights or frequencies) of the current chunk."""
+        decoded = self._decoded[self._part]
+        if decoded is None:
+            return decode_chunk(self._raw_bins[self._part], self._chunk)
+        start = self._chunk * POSTINGS_PER_CHUNK
+        return decoded[0][start:start + POSTINGS_PER_CHUNK], decoded[1][start:start + POSTINGS_PER_CHUNK]
+
+    def _find_chunk(self, target):
+        """Return the first chunk of the current part, from the current one, whose last doc id is not below target."""
+        last_doc_ids, low, step = self._last_doc_ids, self._chunk, 1
+        while low + step < len(last_doc_ids) and last_doc_ids[low + step] < target:
+            low += step
+            step *= 2
+        return bisect_left(last_doc_ids, target, low, min(low + step + 1, len(last_doc_ids)))
+
+    def advance(self, target):
+        """
+        Move to the first posting whose doc id is not lower than target.
+        :return: the doc id of this posting (also in self.doc_id, its weight being in self.weight), or None
+        """
+        while self._part < len(self._raw_bins):
+            if self._last_doc_ids[-1] < target:
+                self._next_part()
+                continue
+            if self._doc_ids is None or self._doc_ids[-1] < target:
+                self._chunk = self._find_chunk(target)
+                doc_ids, weights = self._decode_chunk()
+                self._doc_ids, self._index = doc_ids.tolist(), 0
+                self._weights = weights if self._weighters[self._part] is None else None
+            index = bisect_left(self._doc_ids, target, self._index)
+            while index < len(self._doc_ids) and not self._live_docs.is_live(self._doc_ids[index]):
+                index += 1
+            if index < len(self._doc_ids):
+                self._index = index
+                self.doc_id = self._doc_ids[index]
+                return self.doc_id
+            target = self._doc_ids[-1] + 1  # the rest of the chunk is deleted
+        self.doc_id = None
+        return None
+
+    def read(self):
+        """Decode the whole posting list, without the deleted documents, into (doc_ids, weights) NumPy arrays."""
+        parts = list()
+        for decode, decoded, weighter in zip(self._decoders, self._decoded, self._weighters):
+            doc_ids, weights = decode() if decoded is None else decoded
+            if weighter is not None:
+                weights = _weight_frequencies(weighter, doc_ids, weights, *self._term_statistics)
+            parts.append(self._live_docs.filter(doc_ids, weights))
+        if len(parts) == 1:
+            return parts[0]
+        return tuple([np.concatenate(arrays) for arrays in zip(*parts)])
+
+
+class ArrayCursor(object):
+    """A cursor on decoded postings, e.g. the documents that match a phrase, with the interface of a PostingCursor."""
+
+    def __init__(self, doc_ids, weights):
+        self._doc_ids = doc_ids
+        self._weights = weights
+        self._doc_ids_list = doc_ids.tolist()
+        self._index = 0
+        self.doc_id = None
+
+    def __len__(self):
+        return len(self._doc_ids)
+
+    @property
+    def weight(self):
+        return None if self.doc_id is None else float(self._weights[self._index])
+
+    def advance(self, target):
+        self._index = bisect_left(self._doc_ids_list, target, self._index)
+        self.doc_id = self._doc_ids_list[self._index] if self._index < len(self._doc_ids_list) else None
+        return self.doc_id
+
+    def read(self):
+        return self._doc_ids, self._weights
+
+
+def top_ranks(scores, k):
+    """
+    Return the indexes of the k best scores by decreasing score, ties in increasing index order, without sorting the
+    other scores: the k-th best score is found with numpy.partition, in O(n).
+    """
+    if k >= len(scores):
+        return np.argsort(-scores, kind='stable')
+    threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+    better = np.flatnonzero(scores > threshold)
+    ranks = np.concatenate((better, np.flatnonzero(scores == threshold)[:k - len(better)]))
+    ranks.sort()
+    return ranks[np.argsort(-scores[ranks], kind='stable')]
+
+
+class Results(object):
+    """
+    A paginated cursor on the results of a query, by decreasing score, ties in the order the documents were met.
+
+    Only the first page is selected when the cursor is created (see top_ranks): the other documents are sorted once a
+    later page is asked for. The paths of the documents are only resolved for the pages returned. Iterating over the
+    cursor gives the paths of all the documents, page by page.
+    """
+
+    def __init__(self, doc_ids, scores, id_storer, capacity=10):
+        """
+        :param doc_ids: the doc id of each result, in the order the documents were met
+        :param scores: the score of each result
+        :param capacity: the amount of results per page
+        """
+        self._doc_ids = np.asarray(doc_ids, dtype=np.int64)
+        self._scores = np.asarray(scores, dtype=np.float64)
         self._id_storer = id_storer
-        self._length = len(results)
-        self._capacity = capacity
-        self._results = list()
+        self.capacity = capacity
+        self._ranks = top_ranks(self._scores, capacity)  # the first page, then all the results once sorted
+        self._pages = list()  # the pages resolved so far, as [(path, score)]
         self._cursor = 0
 
     def __len__(self):
-        return self._length
+        return len(self._doc_ids)
 
-    def run(self):
-        self._results.append(self._top_k())
-        self._raw_results.sort(key=operator.itemgetter(1))
-        self._status = True
+    def __iter__(self):
+        for index in range(self.pages_amount()):
+            for path, _ in self._get_page(index):
+                yield path
+
+    def pages_amount(self):
+        return -(-len(self) // self.capacity)
+
+    def _get_page(self, index):
+        while len(self._pages) <= index:
+            start = len(self._pages) * self.capacity
+            if start + self.capacity > len(self._ranks) and len(self._ranks) < len(self):
+                self._ranks = np.argsort(-self._scores, kind='stable')
+            ranks = self._ranks[start:start + self.capacity]
+            self._pages.append([(self._id_storer.doc_map[doc_id], score) for doc_id, score
+                                in zip(self._doc_ids[ranks].tolist(), self._scores[ranks].tolist())])
+        return self._pages[index]
 
     def next(self):
-        while self._cursor != 0 and not self._status:
-            time.sleep(0.05)
-        if len(self._results) - 1 < self._cursor:
-            temp = list()
-            for _ in range(min(self._capacity, len(self._raw_results))):
-                doc_id, score = self._raw_results.pop()
-                temp.append((self._id_storer.doc_map[doc_id], score))
-            self._results.append(temp)
+        """Return the next page of results, as [(path, score)], or an empty list after the last page."""
+        if self._cursor >= self.pages_amount():
+            return list()
         self._cursor += 1
-        return self._results[self._cursor - 1]
+        return self._get_page(self._cursor - 1)
 
     def get_all(self):
+        """Return the results of the pages returned so far, as [(path, score)]."""
         results = list()
-        for result in self._results:
-            results += result
+        for page in self._pages[:self._cursor]:
+            results += page
         return results
 
-    def _top_k(self):
-        capacity = min(self._capacity, len(self))
-        heap = self._raw_results[:capacity]
-        for doc_id, score in self._raw_results[capacity:]:
-            heapq.heappushpop(heap, (score, doc_id))
-        result = list()
-        for _ in range(capacity):
-            score, doc_id = heapq.heappop(heap)
-            result.append((self._id_storer.doc_map[doc_id], score))
-        result.reverse()
-        return result
-
-    def _background_sort(self):
-        self._raw_results = sorted(self._raw_results)  # no in-place sort to avoid inconsistent state of _results
-
 
 class AbstractQueryParser(object):
 
-    def __init__(self, collection, index_path, positions, verbose):
+    def __init__(self, collection, index_path, positions, verbose, segments=None, weight_function_id=None,
+                 cache_memory=None, postings_cache_memory=None, pinned_terms=0):
         """
         :param collection: the working collection
         :param index_path: the file of the index file
-        :param positions: {term_id: position_in_index_file}
+        :param positions: the positions of the posting lists in the index file, ordered by term id
+        :param segments: the SegmentedIndex holding the documents added since the index was built, if any
+        :param weight_function_id: the weight function to apply at query time if the index stores raw frequencies,
+        instead of the one it was built with
+        :param cache_memory: the amount of bytes of query results to cache (see QueryResultCache), None for no cache
+        :param postings_cache_memory: the amount of bytes of decoded posting lists of the index to cache, None for no
+        cache. The segments, small and soon merged, are not cached
+        :param pinned_terms: the amount of terms of highest document frequency whose posting lists are decoded at once
+        and never evicted from the posting list cache
         """
         self.collection = collection
-        self._index_reader = _CollectionIndexReader(index_path, positions)
+        self._index_path = index_path
+        self._index_reader = _CollectionIndexReader(index_path, positions, None if postings_cache_memory is None
+                                                    else LRUCache(postings_cache_memory))
+        settings = load_map("indexes/%s/settings" % collection.collection_path, value_type=int)
+        self.raw_frequencies = settings.get("raw_frequencies", 0) == 1
+        # the weight function applied at query time to the segments, and to the index if it stores raw frequencies
+        self.weight_function_id = settings["weight_function_id"]
+        if self.raw_frequencies and weight_function_id is not None:
+            self.weight_function_id = weight_function_id
+        self._stats = CollectionStats.load("indexes/%s/stats" % collection.collection_path)
+        self.positional = settings.get("positional", 0) == 1
+        self._positional = PositionalIndex("indexes/%s/positional" % collection.collection_path) \
+            if self.positional else None
+        self._forward = None  # (TermDictionary, ForwardIndex), if the index has a forward index
+        if exists("indexes/%s/forward" % collection.collection_path):
+            self._forward = (TermDictionary("indexes/%s/termdict" % collection.collection_path),
+                             ForwardIndex("indexes/%s/forward" % collection.collection_path))
+        self.segments = segments
+        self._segment_readers = dict()  # {segment name: (positions, reader)}, until the segment is merged
+        self.analyzer = Analyzer(tokenizer=alphanumeric_tokenizer)  # shares its stemmer cache with the Parse step
         self.printer = QueryParserPrinter(verbose)
+        self.cache = None if cache_memory is None else QueryResultCache(cache_memory)
+        self.postings_cache = self._index_reader.cache
+        if self.postings_cache is not None and pinned_terms > 0:
+            self.printer.print_pinned_terms_message(self._index_reader.pin_frequent_terms(pinned_terms),
+                                                    self.postings_cache)
+
+    def _get_generation(self):
+        """
+        Return the state of the index the results of a query depend on: its file, replaced when it is built again or
+        compacted, its segments and its deleted documents.
+        """
+        self.collection.live_docs.refresh()
+        segments = tuple() if self.segments is None \
+            else tuple([(segment.name, id(segment.positions)) for segment in self.segments.get_segments()])
+        return os.stat(self._index_path).st_mtime_ns, segments, len(self.collection.live_docs)
+
+    def _cached(self, key, evaluate):
+        """
+        Return the results of a query from the cache, or evaluate them and cache them.
+        :param key: the normalized query, hashable
+        :param evaluate: a function () -> (doc_ids, scores) NumPy arrays of the query
+        """
+        if self.cache is None:
+            return evaluate()
+        generation = self._get_generation()
+        results = self.cache.get(key, generation)
+        if results is None:
+            results = evaluate()
+            self.cache.put(key, results)
+        return results
+
+    def _get_segment_reader(self, segment):
+        reader = self._segment_readers.get(segment.name)
+        if reader is None or reader[0] is not segment.positions:  # a new segment, or a compacted one
+            self._segment_readers = {s.name: self._segment_readers[s.name]
+                                     for s in self.segments.get_segments() if s.name in self._segment_readers}
+            reader = (segment.positions, _CollectionIndexReader(segment.index_path, segment.positions))
+            self._segment_readers[segment.name] = reader
+        return reader[1]
+
+    def _get_sources(self):
+        """
+        Return the _Source of the index and of each segment, ordered by doc ids.
+
+        The segments, and the index if it stores raw frequencies, are weighted at query time as a single collection:
+        their Weighter uses the collection size and the average document length of the index and of all the live
+        segments, and the df and the cf of a term over all of them (see _get_term_statistics).
+        """
+        self.collection.live_docs.refresh()
+        parts = [(self.collection.id_storer.term_map, self._index_reader, self._stats, self.raw_frequencies,
+                  self._positional, self._forward)]
+        if self.segments is not None:
+            parts += [(segment.term_map, self._get_segment_reader(segment), segment.stats, True, segment.positional,
+                       None if segment.forward is None else (segment.term_map, segment.forward))
+                      for segment in self.segments.get_segments()]
+        all_stats = [part[2] for part in parts]
+        collection_size = sum([stats.collection_size for stats in all_stats])
+        average_doc_length = all_stats[0].average_doc_length  # exactly the one of the index if it has no segments
+        if len(all_stats) > 1:
+            average_doc_length = sum([stats.collection_size * stats.average_doc_length for stats in all_stats]) \
+                / float(max(collection_size, 1))
+        return [_Source(term_map, index_reader, stats,
+                        self._get_weighter(stats.within(collection_size, average_doc_length)) if raw else None,
+                        positional_index, forward)
+                for term_map, index_reader, stats, raw, positional_index, forward in parts]
+
+    def _get_weighter(self, stats):
+        return WeightFactory.get_weight_function(self.weight_function_id, stats.collection_size, stats.first_doc_id,
+                                                 stats)
+
+    @staticmethod
+    def _get_term_statistics(sources, terms):
+        """
+        Get the df and the cf of terms over the index and its segments, to weight their frequencies with: the df is the
+        length of the posting lists, read without decoding them, and the cf is read from the statistics.
+        :return: {term: (df, cf)} for the terms found in the index, empty if no frequencies are weighted at query time
+        """
+        statistics = dict()
+        if all([source.weighter is None for source in sources]):
+            return statistics
+        for source in sources:
+            terms_by_id = {source.term_map[term]: term for term in terms if term in source.term_map}
+            for term_id, raw_bin in source.index_reader.read_binaries(terms_by_id.keys()).items():
+                df, cf = statistics.get(terms_by_id[term_id], (0, 0))
+                statistics[terms_by_id[term_id]] = (df + decode_posting_list_length(raw_bin),
+                                                    cf + int(source.stats.collection_frequencies[term_id - 1]))
+        return statistics
+
+    def _read_posting_lists(self, terms):
+        """
+        Get the posting lists of a list of terms from the index and from its segments, without the deleted documents.
+        :return: {term: (doc_ids, weights)} for the terms found in the index, in the order of terms
+        """
+        live_docs = self.collection.live_docs
+        sources = self._get_sources()
+        statistics = self._get_term_statistics(sources, terms)
+        parts = dict()
+        for source in sources:
+            terms_by_id = {source.term_map[term]: term for term in terms if term in source.term_map}
+            for term_id, (doc_ids, weights) in source.index_reader.read(terms_by_id.keys(), refined=True).items():
+                term = terms_by_id[term_id]
+                if source.weighter is not None:  # weighted before the deleted documents are filtered, as when built
+                    weights = _weight_frequencies(source.weighter, doc_ids, weights, *statistics[term])
+                parts.setdefault(term, list()).append(live_docs.filter(doc_ids, weights))
+        return {term: posting_lists[0] if len(posting_lists) == 1
+                else tuple([np.concatenate(arrays) for arrays in zip(*posting_lists)])
+                for term, posting_lists in parts.items()}
+
+    def _open_cursors(self, terms):
+        """
+        Open a cursor on the posting list of each term, in the index and in its segments, without decoding it unless it
+        is cached.
+        :return: {term: PostingCursor} for the terms found in the index, in the order of terms
+        """
+        sources = self._get_sources()
+        statistics = self._get_term_statistics(sources, terms)
+        parts = dict()
+        for source in sources:
+            index_reader = source.index_reader
+            terms_by_id = {source.term_map[term]: term for term in terms if term in source.term_map}
+            for term_id, raw_bin in index_reader.read_binaries(terms_by_id.keys()).items():
+                decode = partial(index_reader.decode, term_id)
+                parts.setdefault(terms_by_id[term_id], list()).append(
+                    (raw_bin, source.weighter, decode, decode() if index_reader.is_cached(term_id) else None))
+        cursors = dict()
+        for term, part in parts.items():
+            raw_bins, weighters, decoders, decoded = [list(values) for values in zip(*part)]
+            cursors[term] = PostingCursor(raw_bins, self.collection.live_docs, weighters, decoders, decoded,
+                                          statistics.get(term))
+        return cursors
+
+    def _parse_positional_expression(self, text):
+        """
+        Return the (terms, distance) of a phrase, whose distance is None, or of a proximity query (see
+        POSITIONAL_EXPRESSION), analyzed as in the index, or None if text is neither.
+        """
+        match = POSITIONAL_EXPRESSION.fullmatch(text.strip())
+        if match is None:
+            return None
+        if match.group(1) is not None:
+            return self.analyzer.analyze(match.group(1)), None
+        return self.analyzer.analyze(match.group(2)) + self.analyzer.analyze(match.group(4)), int(match.group(3))
+
+    def _match_positions(self, terms, distance=None):
+        """
+        Get the documents where terms follow each other (a phrase) or, given a distance, where each term is at most
+        distance terms away from the next one (a proximity query). The positions of the terms are only decoded for
+        the documents that hold all of them.
+
+        Positions are ranks among the terms of a document: common words are not counted, like in the analyzed query.
+        :return: (doc_ids, weights) NumPy arrays of the live documents that match, the weight of a document being the
+        sum of the weights of the terms
+        """
+        if not self.positional:
+            self.printer.print_missing_positions_message()
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        sources = self._get_sources()
+        statistics = self._get_term_statistics(sources, terms)
+        doc_ids_parts, weights_parts = list(), list()
+        for source in sources:
+            term_ids = [source.term_map.get(term) for term in terms]
+            if len(term_ids) == 0 or None in term_ids:
+                continue
+            posting_lists = source.index_reader.read(set(term_ids), refined=True)
+            if source.weighter is not None:
+                terms_by_id = dict(zip(term_ids, terms))
+                posting_lists = {term_id: (doc_ids, _weight_frequencies(source.weighter, doc_ids, weights,
+                                                                        *statistics[terms_by_id[term_id]]))
+                                 for term_id, (doc_ids, weights) in posting_lists.items()}
+            candidates = reduce(_intersect_sorted, sorted([doc_ids for doc_ids, _ in posting_lists.values()], key=len))
+            candidates = self.collection.live_docs.filter(candidates, candidates)[0]
+            if len(term_ids) > 1 and len(candidates) > 0:
+                keys = dict()
+                for term_id, (doc_ids, _) in posting_lists.items():
+                    owners, positions = source.positional.get(term_id, np.searchsorted(doc_ids, candidates))
+                    keys[term_id] = owners << 32 | positions
+                keys = [keys[term_id] for term_id in term_ids]
+                candidates = candidates[_match_phrase(keys) if distance is None else _match_near(keys, distance)]
+            doc_ids_parts.append(candidates)
+            weights_parts.append(sum([weights[np.searchsorted(doc_ids, candidates)].astype(np.float64)
+                                      for doc_ids, weights in posting_lists.values()]))
+        if len(doc_ids_parts) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+        return np.concatenate(doc_ids_parts), np.concatenate(weights_parts)
+
+    def _read_doc_vectors(self, doc_ids):
+        """
+        Get the vectors of a list of documents from the forward indexes of the index and of its segments.
+
+        The frequencies of the segments, and of the index if it stores raw frequencies, are weighted at once for each
+        term, with its df and its cf over the index and its segments, as in the posting lists.
+        :return: [{term: weight}] in the order of doc_ids, an empty vector for a document without a forward index
+        """
+        sources = self._get_sources()
+        parts = list()  # the (source, doc_ids, term_ids, weights or frequencies, {term_id: term}) of each forward index
+        for source in sources:
+            if source.forward is None:
+                continue
+            term_dictionary, forward_index = source.forward
+            source_doc_ids = [doc_id for doc_id in doc_ids if doc_id in forward_index]
+            if len(source_doc_ids) == 0:
+                continue
+            vectors = [forward_index.get(doc_id) for doc_id in source_doc_ids]
+            term_ids = np.concatenate([vector_term_ids for vector_term_ids, _ in vectors])
+            weights = np.concatenate([vector_weights for _, vector_weights in vectors])
+            terms = {term_id: term_dictionary.get_term(term_id) for term_id in np.unique(term_ids).tolist()}
+            parts.append((source, np.repeat(source_doc_ids, [len(vector_term_ids) for vector_term_ids, _ in vectors]),
+                          term_ids, weights, terms))
+        statistics = self._get_term_statistics(sources, set([term for part in parts if part[0].weighter is not None
+                                                             for term in part[4].values()]))
+        vectors = dict()
+        for source, owners, term_ids, weights, terms in parts:
+            if source.weighter is not None:
+                weights = self._weight_vectors(source.weighter, term_ids, owners, weights,
+                                               {term_id: statistics[term] for term_id, term in terms.items()})
+            for doc_id, term_id, weight in zip(owners.tolist(), term_ids.tolist(), weights.tolist()):
+                vectors.setdefault(doc_id, dict())[terms[term_id]] = weight
+        return [vectors.get(doc_id, dict()) for doc_id in doc_ids]
+
+    @staticmethod
+    def _weight_vectors(weighter, term_ids, doc_ids, tfs, term_statistics):
+        """
+        Weight the frequencies of the vectors of an index, grouped by term.
+        :param term_statistics: {term_id: (df, cf)} of the terms over the index and its segments
+        """
+        order = np.argsort(term_ids, kind='stable')
+        unique_term_ids, starts = np.unique(term_ids[order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        weights = np.empty(len(tfs), dtype='=f4')
+        for term_id, start, end in zip(unique_term_ids.tolist(), starts, ends):
+            indexes = order[start:end]
+            weights[indexes] = _weight_frequencies(weighter, doc_ids[indexes], tfs[indexes], *term_statistics[term_id])
+        return weights
 
     def execute_query(self, query):
         """
@@ -0,0 +1,55 @@
+import numpy as np
+
+
+class ScoreAccumulator(object):
+    """
+    The scores of the documents of a query, as a dense array indexed by doc id, allocated once and reused by each query.
+
+    The weights of a posting list are added to the scores of its documents at once (a scatter-add, its doc ids being
+    unique), and only the scores of the documents met are read, then reset for the next query.
+    """
+
+    def __init__(self, size):
+        self._scores = np.zeros(size)
+        self._met = np.zeros(size, dtype=bool)
+
+    def _reserve(self, size):
+        """Grow the arrays to hold size documents, e.g. the documents of a new segment."""
+        if size > len(self._scores):
+            self._scores = np.concatenate((self._scores, np.zeros(size - len(self._scores))))
+            self._met = np.concatenate((self._met, np.zeros(size - len(self._met), dtype=bool)))
+
+    def score(self, posting_lists, freqs):
+        """
+        Sum the weights of the documents over the posting lists.
+        :param posting_lists: {term: (doc_ids, weights)} of the query, with increasing doc ids
+        :param freqs: {term: weight} of the query
+        :return: (doc_ids, scores) NumPy arrays, in the order the documents are met
+        """
+        met = list()
+        for term, (doc_ids, weights) in posting_lists.items():
+            if len(doc_ids) == 0:
+                continue
+            self._reserve(int(doc_ids[-1]) + 1)
+            new_doc_ids = doc_ids[~self._met[doc_ids]]
+            self._met[new_doc_ids] = True
+            met.append(new_doc_ids)
+            self._scores[doc_ids] += weights.astype(np.float64) * freqs[term]
+        if len(met) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0)
+        doc_ids = np.concatenate(met)
+        scores = self._scores[doc_ids]
+        self._scores[doc_ids] = 0
+        self._met[doc_ids] = False
+        return doc_ids, scores
+
+    def lookup(self, doc_ids, weights, targets):
+        """
+        Return the weights of increasing target doc ids in a non-empty posting list, 0 if missing: the weights are
+        scattered in the dense array, read at the targets, then reset.
+        """
+        self._reserve(max(int(doc_ids[-1]), int(targets[-1])) + 1)
+        self._scores[doc_ids] = weights
+        result = self._scores[targets]
+        self._scores[doc_ids] = 0
+        return result
@@ -1,8 +1,12 @@
-import operator
+from itertools import compress
 
 import time
 
-from queries.abstract_queries import AbstractQueryParser
+import numpy as np
+
+from queries.abstract_queries import AbstractQueryParser, ArrayCursor, Results
+
+_LOOKUP_RATIO = 32  # doc ids are looked up with cursors if the disjunction holds this many times more postings
 
 
 class BooleanQueryParser(AbstractQueryParser):
@@ -13,6 +17,8 @@ class BooleanQueryParser(AbstractQueryParser):
         - the query is written in CNF, i.e. a conjunction of disjunctions
         - disjunctions are separated with the && (AND) operator
         - a disjunction is a list of terms separated with the || (OR) operator and surrounded with parenthesis
+        - with a positional index, a term of a disjunction can be replaced with a phrase ("stanford university") or a
+          proximity query (stanford NEAR/3 university)
     Two extra rules ensure that queries are well-defined:
         - the NOT operator can only apply to a disjunction (and not to a term)
             --> (foobar) && !(foo || bar) is well-defined
@@ -25,28 +31,59 @@ class BooleanQueryParser(AbstractQueryParser):
     This implementation assumes that the main use-case of the NOT operator is to filter an existing query,
     but not to get the complement of a query.
     Hence the two rules described above.
+
+    A query is evaluated in its canonical form, which also keys its results in the cache: its disjunctions and their
+    items are sorted sets of analyzed terms, phrases and proximity queries.
     """
 
-    def __init__(self, collection, index_path, positions, verbose):
-        AbstractQueryParser.__init__(self, collection, index_path, positions, verbose)
+    def __init__(self, collection, index_path, positions, verbose, segments=None, weight_function_id=None,
+                 cache_memory=None, postings_cache_memory=None, pinned_terms=0):
+        AbstractQueryParser.__init__(self, collection, index_path, positions, verbose, segments, weight_function_id,
+                                     cache_memory, postings_cache_memory, pinned_terms)
         self.printer.print_query_constraints()
 
     def execute_query(self, query):
-        # type: (str) -> list
+        # type: (str) -> Results
         """
         Execute a boolean query.
         :param query: a CNF query
+        :return: a cursor on the matching documents, by decreasing score
         """
         start = time.time()
-        docs = self._evaluate_query(query)
-        results = sorted(docs, key=operator.itemgetter(1), reverse=True)
-        self.printer.print_results([(self.collection.id_storer.doc_map[doc[0]], doc[1]) for doc in results],
-                                   time.time() - start)
-        return [self.collection.id_storer.doc_map[doc[0]] for doc in docs]
+        cnf = self._normalize_cnf(query)
+        results = self._cached(cnf, lambda: self._evaluate_query(cnf))
+        results = Results(*results, self.collection.id_storer)
+        self.printer.print_results(results, time.time() - start)
+        self.printer.print_cache_message(self.cache)
+        self.printer.print_cache_message(self.postings_cache, "Posting list cache")
+        return results
+
+    def _normalize_disjunction(self, query):
+        # type (str) -> tuple
+        """
+        Return the canonical form of a disjunction: the sorted set of its terms, analyzed as in the index (a common word
+        is dropped), and the sorted set of the (terms, distance) of its phrases, whose distance is -1, and proximity
+        queries.
+        """
+        words, expressions = set(), set()
+        for item in query.split(" || "):
+            expression = self._parse_positional_expression(item)
+            if expression is None:
+                words.update(self.analyzer.analyze(item))
+            else:
+                expressions.add((tuple(expression[0]), -1 if expression[1] is None else expression[1]))
+        return tuple(sorted(words)), tuple(sorted(expressions))
 
-    def _get_word_from_disjunction(self, query):
-        # type (str) -> list[str]
-        return [word.lower() for word in query.split(" || ")]
+    def _get_cursors_from_disjunction(self, disjunction):
+        # type (tuple) -> list
+        """
+        Return a cursor on the postings of each item of a canonical disjunction: its terms (an unknown term is removed),
+        and its phrases and proximity queries, evaluated at once.
+        """
+        words, expressions = disjunction
+        cursors = [ArrayCursor(*self._match_positions(list(terms), None if distance == -1 else distance))
+                   for terms, distance in expressions]
+        return list(self._open_cursors(words).values()) + cursors
 
     def _split_cnf_to_disjunctions(self, conjunction):
         """
@@ -55,47 +92,61 @@ class BooleanQueryParser(AbstractQueryParser):
         One list is for "positive" disjunctions and the other for "negative" disjunctions.
         """
         disjunctions = conjunction.split(" && ")
-        words_from_disjunction = self._get_word_from_disjunction
-        pos_disjs = [words_from_disjunction(disjunction[1:-1]) for disjunction in disjunctions if disjunction[0] != '!']
-        neg_disjs = [words_from_disjunction(disjunction[2:-1]) for disjunction in disjunctions if disjunction[0] == '!']
+        pos_disjs = [disjunction[1:-1] for disjunction in disjunctions if disjunction[0] != '!']
+        neg_disjs = [disjunction[2:-1] for disjunction in disjunctions if disjunction[0] == '!']
         return pos_disjs, neg_disjs
 
-    def _terms_cnf_to_ids_cnf(self, cnf):
-        """
-        Replace terms in a CNF by their id.
-
-        Unknown terms are removed.
-        """
-        term_map = self.collection.id_storer.term_map
-        return [[term_map[term] for term in disjunction if term in term_map] for disjunction in cnf]
-
-    def _evaluate_query(self, query):
+    def _normalize_cnf(self, query):
+        """Return the canonical form of a CNF: the sorted sets of its positive and of its negative disjunctions."""
         pos_disjunctions, neg_disjunctions = self._split_cnf_to_disjunctions(query)
-        pos_ids_cnf = self._terms_cnf_to_ids_cnf(pos_disjunctions)
-        neg_ids_cnf = self._terms_cnf_to_ids_cnf(neg_disjunctions)
-        pos_ids_cnf = [self._index_reader.read(term_ids, refined=True).values() for term_ids in pos_ids_cnf]
-        neg_ids_cnf = [self._index_reader.read(term_ids, refined=True).values() for term_ids in neg_ids_cnf]
-        conjunction = Conjunction((pos_ids_cnf, neg_ids_cnf))
-        return conjunction.evaluate()
+        return (tuple(sorted(set([self._normalize_disjunction(disjunction) for disjunction in pos_disjunctions]))),
+                tuple(sorted(set([self._normalize_disjunction(disjunction) for disjunction in neg_disjunctions]))))
+
+    def _evaluate_query(self, cnf):
+        """Evaluate a canonical CNF into (doc_ids, scores) NumPy arrays, by increasing doc id."""
+        pos_cnf = [self._get_cursors_from_disjunction(disjunction) for disjunction in cnf[0]]
+        neg_cnf = [self._get_cursors_from_disjunction(disjunction) for disjunction in cnf[1]]
+        docs = Conjunction((pos_cnf, neg_cnf)).evaluate()
+        return np.array([doc[0] for doc in docs], dtype=np.int64), np.array([doc[1] for doc in docs])
 
 
 class Disjunction(object):
     """
-    Representation of a disjunction of posting lists.
+    Representation of a disjunction of posting lists, given as PostingCursors.
     """
 
-    def __init__(self, posting_lists):
-        self.posting_lists = posting_lists
+    def __init__(self, cursors):
+        self.cursors = cursors
 
     def __len__(self):
-        return sum([len(posting_list) for posting_list in self.posting_lists])
+        return sum([len(cursor) for cursor in self.cursors])
 
     def evaluate(self):
         result = list()
-        for posting_list in self.posting_lists:
-            result = self._union(result, posting_list)
+        for cursor in self.cursors:
+            doc_ids, weights = cursor.read()
+            result = self._union(result, list(zip(doc_ids.tolist(), weights.tolist())))
         return result
 
+    def contains(self, doc_id):
+        """
+        Return True iff a posting list of this disjunction holds doc_id. Doc ids must be checked in increasing order.
+        """
+        return any([cursor.advance(doc_id) == doc_id for cursor in self.cursors])
+
+    def lookup(self, doc_ids):
+        """
+        Return a boolean mask of the doc ids, given in increasing order, held by a posting list of this disjunction.
+
+        Each doc id is looked up with the cursors if they are few compared to the postings of the disjunction: otherwise
+        decoding the posting lists at once costs less than a cursor move per doc id.
+        """
+        if len(self) > _LOOKUP_RATIO * len(doc_ids):
+            return np.array([self.contains(doc_id) for doc_id in doc_ids], dtype=bool)
+        if len(self.cursors) == 0:
+            return np.zeros(len(doc_ids), dtype=bool)
+        return np.isin(doc_ids, np.concatenate([cursor.read()[0] for cursor in self.cursors]))
+
     def _union(self, occurrences1, occurrences2):
         """
         Return the set union between two posting lists.
@@ -137,69 +188,33 @@ class Conjunction(object):
     def evaluate(self):
         """
         Evaluate this CNF.
+
+        Only the shortest positive disjunction is decoded: its postings are then looked up in the other disjunctions,
+        whose cursors skip the chunks of postings in between (see PostingCursor).
         :return: the postings that satisfy this CNF
         """
         if len(self._pos_disjunctions) == 0:
             print("\tQueries only containing negative disjunctions won't be processed!")
             return list()
-        pos_result = self._evaluate_same_type_conjunction(self._pos_disjunctions)
-        neg_result = self._evaluate_same_type_conjunction(self._neg_disjunctions)
-        return self._diff(pos_result, neg_result)
+        result = self._pos_disjunctions[0].evaluate()
+        for disjunction in self._pos_disjunctions[1:]:
+            result = self._intersection(result, disjunction)
+        return self._diff(result, self._neg_disjunctions)
 
-    def _evaluate_same_type_conjunction(self, disjunctions):
+    def _intersection(self, occurrences, disjunction):
         """
-        Recursivel(ish)y evaluate a conjunction of disjunctions.
+        Return the postings of a posting list whose doc id is found in a disjunction.
         """
-        if len(disjunctions) == 0:
-            return list()
-        result = disjunctions[0].evaluate()
-        for disjunction in disjunctions[1:]:
-            result = self._intersection(result, disjunction.evaluate())
-        return result
-
-    def _intersection(self, occurrences1, occurrences2):
-        """
-        Return the set intersection between two posting lists.
-        """
-        index1, index2 = 0, 0
-        result = list()
-        while index1 + index2 < len(occurrences1) + len(occurrences2):
-            if index2 >= len(occurrences2) or index1 >= len(occurrences1):
-                break
-            else:
-                item1 = occurrences1[index1]
-                item2 = occurrences2[index2]
-                if item1[0] < item2[0]:
-                    index1 += 1
-                elif item1[0] > item2[0]:
-                    index2 += 1
-                else:
-                    result.append(item1)
-                    index1 += 1
-                    index2 += 1
-        return result
+        return list(compress(occurrences, disjunction.lookup([occurrence[0] for occurrence in occurrences])))
 
-    def _diff(self, pos_occs, neg_occs):
+    def _diff(self, pos_occs, neg_disjunctions):
         """
-        Return the set difference between two posting lists.
+        Return the postings of a posting list whose doc id is not found in all the negative disjunctions.
         """
-        index1, index2 = 0, 0
-        result = list()
-        while index1 + index2 < len(pos_occs) + len(neg_occs):
-            if index1 >= len(pos_occs):
-                break
-            elif index2 >= len(neg_occs):
-                result.append(pos_occs[index1])
-                index1 += 1
-            else:
-                item1 = pos_occs[index1]
-                item2 = neg_occs[index2]
-                if item1[0] < item2[0]:
-                    result.append(item1)
-                    index1 += 1
-                elif item1[0] > item2[0]:
-                    index2 += 1
-                else:
-                    index1 += 1
-                    index2 += 1
-        return result
+        if len(neg_disjunctions) == 0:
+            return pos_occs
+        doc_ids = [occurrence[0] for occurrence in pos_occs]
+        found = np.ones(len(doc_ids), dtype=bool)
+        for disjunction in neg_disjunctions:
+            found &= disjunction.lookup(doc_ids)
+        return list(compress(pos_occs, ~found))
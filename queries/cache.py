@@ -0,0 +1,110 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A cache within a memory budget: the least recently used entries are evicted first, except the pinned ones, which
+    are never evicted. Lookups are counted as hits and misses.
+    """
+
+    def __init__(self, capacity):
+        """
+        :param capacity: the amount of bytes the entries may take
+        """
+        self.capacity = capacity
+        self._entries = OrderedDict()  # {key: (value, size)}, the least recently used first
+        self._pinned = dict()  # {key: (value, size)}
+        self._pinned_size = 0
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
+
+    def __contains__(self, key):
+        return key in self._pinned or key in self._entries
+
+    def size(self):
+        """Return the amount of bytes taken by the entries."""
+        return self._size
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def clear(self):
+        """Drop the entries, except the pinned ones."""
+        self._entries.clear()
+        self._size = self._pinned_size
+
+    def _evict(self):
+        while self._size > self.capacity and len(self._entries) > 0:
+            self._size -= self._entries.popitem(last=False)[1][1]
+
+    def get(self, key):
+        """Return the value of a key, or None if it is not cached."""
+        entry = self._pinned.get(key)
+        if entry is None:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size):
+        """Cache the value of a key, evicting the least recently used entries beyond the capacity."""
+        if key in self._pinned or size > self.capacity:
+            return
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        self._entries[key] = (value, size)
+        self._size += size
+        self._evict()
+
+    def pin(self, key, value, size):
+        """
+        Cache the value of a key for good, unless the pinned entries would exceed the capacity.
+        :return: True if the value is pinned
+        """
+        if key in self._pinned:
+            return True
+        if self._pinned_size + size > self.capacity:
+            return False
+        if key in self._entries:
+            self._size -= self._entries.pop(key)[1]
+        self._pinned[key] = (value, size)
+        self._pinned_size += size
+        self._size += size
+        self._evict()
+        return True
+
+
+class QueryResultCache(LRUCache):
+    """
+    The results of the last queries, keyed by normalized query, within a memory budget: the least recently used
+    results are evicted first.
+
+    Each lookup gives the generation of the index (see AbstractQueryParser._get_generation): all the results are
+    dropped as soon as it changes, e.g. when the index is built again.
+    """
+
+    def __init__(self, capacity):
+        LRUCache.__init__(self, capacity)
+        self._generation = None
+
+    def get(self, key, generation):
+        """Return the results of a query, or None if they are not cached for this generation of the index."""
+        if generation != self._generation:
+            self.clear()
+            self._generation = generation
+        return LRUCache.get(self, key)
+
+    def put(self, key, results):
+        """
+        Cache the results of a query.
+        :param results: the (doc_ids, scores) NumPy arrays of the query, which must not be modified afterwards
+        """
+        LRUCache.put(self, key, results, sum([array.nbytes for array in results]) + len(repr(key)))
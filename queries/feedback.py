@@ -0,0 +1,45 @@
+import heapq
+from math import sqrt
+
+
+def _normalize(vector):
+    norm = sqrt(sum([weight * weight for weight in vector.values()]))
+    if norm == 0:
+        return dict()
+    return {term: weight / norm for term, weight in vector.items()}
+
+
+class Rocchio(object):
+    """
+    Pseudo-relevance feedback: the top documents of a query are assumed to be relevant, and the query is moved towards
+    their centroid.
+
+    The expanded query is alpha * q + beta * (d_1 + ... + d_k) / k, where q and the vectors d_i of the top documents
+    (read from the forward index) are normalized, keeping the terms of q and the terms_amount heaviest other terms.
+    """
+
+    def __init__(self, docs_amount=10, terms_amount=20, alpha=1.0, beta=0.75):
+        self.docs_amount = docs_amount
+        self.terms_amount = terms_amount
+        self.alpha = alpha
+        self.beta = beta
+
+    def expand(self, freqs, doc_vectors):
+        """
+        Expand a query with the vectors of its top documents.
+        :param freqs: {term: frequency} of the query
+        :param doc_vectors: [{term: weight}] of the top documents
+        :return: {term: weight} of the expanded query
+        """
+        query = {term: self.alpha * weight for term, weight in _normalize(freqs).items()}
+        if len(doc_vectors) == 0:
+            return query
+        centroid = dict()
+        for vector in doc_vectors:
+            for term, weight in _normalize(vector).items():
+                centroid[term] = centroid.get(term, 0) + weight
+        expansion = heapq.nlargest(self.terms_amount, [term for term in centroid if term not in query],
+                                   key=lambda term: (centroid[term], term))
+        for term in list(query) + expansion:
+            query[term] = query.get(term, 0) + self.beta * centroid.get(term, 0) / len(doc_vectors)
+        return query
@@ -1,37 +1,116 @@
-import operator
-
 import time
 
-import re
+import numpy as np
 
-from queries.abstract_queries import AbstractQueryParser
-from porterstemmer import Stemmer
+from queries.abstract_queries import AbstractQueryParser, Results, POSITIONAL_EXPRESSION, top_ranks
+from queries.accumulator import ScoreAccumulator
 
 
 class VectorQueryParser(AbstractQueryParser):
+    """
+    Implementation of a query parser that ranks documents in the vector model.
+
+    With a positional index, a query may hold phrases ("stanford university") and proximity queries (stanford NEAR/3
+    university): only the documents that match all of them are ranked, and their terms are scored like the others.
+
+    With top_k, only the top_k best documents are returned: all the documents are scored, and the top_k best ones
+    selected without sorting the others (see top_ranks).
+
+    With a cache, the results are keyed by the multiset of the analyzed terms of the query and by the set of its phrases
+    and proximity queries: queries that only differ in word order, case or inflection share their results.
+    """
+
+    def __init__(self, collection, index_path, positions, verbose, segments=None, weight_function_id=None,
+                 feedback=None, top_k=None, cache_memory=None, postings_cache_memory=None, pinned_terms=0):
+        """
+        :param feedback: a query expansion (e.g. feedback.Rocchio) applied to the top documents of each query, if any
+        :param top_k: the amount of documents to return, None for all the matching documents
+        """
+        AbstractQueryParser.__init__(self, collection, index_path, positions, verbose, segments, weight_function_id,
+                                     cache_memory, postings_cache_memory, pinned_terms)
+        self.feedback = feedback
+        if feedback is not None and self._forward is None:
+            self.printer.print_missing_forward_index_message()
+        self.top_k = top_k
+        self._accumulator = ScoreAccumulator(len(collection))
 
     def _clean_query(self, query):
-        stemmer = Stemmer()
-        result = ""
-        for word in filter(None, re.split('[^a-zA-Z\d:]', query)):
-            result += stemmer(word.lower()) + " "
-        return result
+        return self.analyzer.analyze(query)
+
+    def _split_positional_expressions(self, query):
+        """Return the query without its phrase and NEAR operators, and the (terms, distance) of its expressions."""
+        expressions = [self._parse_positional_expression(match.group(0))
+                       for match in POSITIONAL_EXPRESSION.finditer(query)]
+        words = POSITIONAL_EXPRESSION.sub(lambda match: " ".join([group for group in match.group(1, 2, 4)
+                                                                  if group is not None]), query)
+        return words, expressions
+
+    def _restrict(self, posting_lists, doc_ids):
+        """Keep the postings of the given documents only, or all of them if doc_ids is None."""
+        if doc_ids is None:
+            return posting_lists
+        restricted = dict()
+        for term, (term_doc_ids, weights) in posting_lists.items():
+            kept = np.isin(term_doc_ids, doc_ids, assume_unique=True)
+            restricted[term] = (term_doc_ids[kept], weights[kept])
+        return restricted
+
+    def _score(self, posting_lists, freqs):
+        """
+        Sum the weights of the documents over the posting lists, without a Python loop on postings (see
+        ScoreAccumulator).
+        :return: (doc_ids, scores) NumPy arrays, in the order the documents are met
+        """
+        return self._accumulator.score(posting_lists, freqs)
+
+    def _rank(self, freqs, doc_ids=None):
+        """
+        Score the documents of a query, restricted to doc_ids if not None.
+        :param freqs: {term: weight} of the query
+        :return: (doc_ids, scores) NumPy arrays, only the top_k best ones if set
+        """
+        doc_ids, scores = self._score(self._restrict(self._read_posting_lists(freqs.keys()), doc_ids), freqs)
+        if self.top_k is None:
+            return doc_ids, scores
+        ranks = top_ranks(scores, self.top_k)
+        return doc_ids[ranks], scores[ranks]
+
+    def _expand(self, freqs, results, doc_ids=None):
+        """Score the query again, expanded with the vectors of its top documents (pseudo-relevance feedback)."""
+        result_doc_ids, scores = results
+        doc_vectors = self._read_doc_vectors(result_doc_ids[top_ranks(scores, self.feedback.docs_amount)].tolist())
+        expanded_freqs = self.feedback.expand(freqs, doc_vectors)
+        self.printer.print_expanded_query([term for term in expanded_freqs if term not in freqs])
+        return self._rank(expanded_freqs, doc_ids)
+
+    def _evaluate_query(self, freqs, expressions):
+        """
+        Rank the documents of a query.
+        :param freqs: {term: weight} of the query
+        :param expressions: the (terms, distance) of its phrases and proximity queries
+        :return: (doc_ids, scores) NumPy arrays
+        """
+        doc_ids = None  # the documents that match the phrases and proximity queries, if any
+        for expression in expressions:
+            matches = self._match_positions(*expression)[0]
+            doc_ids = matches if doc_ids is None else np.intersect1d(doc_ids, matches, assume_unique=True)
+        results = self._rank(freqs, doc_ids)
+        if self.feedback is not None and len(results[0]) > 0:
+            results = self._expand(freqs, results, doc_ids)
+        return results
 
     def execute_query(self, query):
         start = time.time()
-        score = dict()
+        query, expressions = self._split_positional_expressions(query)
         freqs = dict()
-        query = self._clean_query(query)
-        term_map = self.collection.id_storer.term_map
-        term_ids = [term_map[w] for w in query.split() if w in term_map]
-        for id in term_ids:
-            freqs[id] = freqs.get(id, 0) + 1
+        for term in self._clean_query(query):
+            freqs[term] = freqs.get(term, 0) + 1
         # To avoid unnecessary reads to index, we will work with freqs (contains no duplicates)
-        posting_lists = self._index_reader.read(freqs.keys(), refined=True)
-        for term_id in posting_lists:
-            for doc_id, weight in posting_lists[term_id]:
-                score[doc_id] = score.get(doc_id, 0) + weight * freqs[term_id]
-        results = sorted(score.items(), key=operator.itemgetter(1), reverse=True)
-        self.printer.print_results([(self.collection.id_storer.doc_map[d_id], score) for d_id, score in results],
-                                   time.time() - start)
-        return [self.collection.id_storer.doc_map[result[0]] for result in results]
+        key = (tuple(sorted(freqs.items())), tuple(sorted(set([(tuple(terms), -1 if distance is None else distance)
+                                                               for terms, distance in expressions]))))
+        results = self._cached(key, lambda: self._evaluate_query(freqs, expressions))
+        results = Results(*results, self.collection.id_storer)
+        self.printer.print_results(results, time.time() - start)
+        self.printer.print_cache_message(self.cache)
+        self.printer.print_cache_message(self.postings_cache, "Posting list cache")
+        return results
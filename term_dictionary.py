@@ -0,0 +1,140 @@
+import mmap
+import struct
+from os import replace
+
+from utils import make_dirs
+
+_HEADER = struct.Struct('<4sII')  # magic number, amount of terms, amount of terms per block
+_MAGIC = b"TSD1"
+_OFFSET = struct.Struct('<Q')
+
+
+def _encode_varint(value):
+    result = bytearray()
+    while value >= 0x80:
+        result.append(value & 0x7f | 0x80)
+        value >>= 7
+    result.append(value)
+    return result
+
+
+def _decode_varint(data, offset):
+    """Return the varint found at offset and the offset of the next byte."""
+    value, shift = 0, 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+class TermDictionary(object):
+    """
+    A {term: term_id} map stored in a binary file and read through mmap, since term ids follow the order of the terms.
+
+    Terms are front-coded in blocks: each term is stored as the length of the prefix it shares with the previous term
+    and its remaining suffix, the first term of a block sharing no prefix. The offsets of the blocks follow the header,
+    so that a lookup is a binary search on the first terms of the blocks and the scan of one block. Hence opening the
+    dictionary costs a file open, and the pages of the file are shared by all the processes that query the index.
+    """
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        with open(file_path, 'rb') as dictionary_file:
+            self._data = mmap.mmap(dictionary_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self._length, self._block_size = _HEADER.unpack_from(self._data)
+        if magic != _MAGIC:
+            raise ValueError("%s is not a term dictionary: build the index again" % file_path)
+        self._blocks_amount = -(-self._length // self._block_size)
+
+    @staticmethod
+    def write(terms, file_path, block_size=16):
+        """
+        Write a term dictionary, replacing any existing file at once.
+        :param terms: the terms ordered by term id, which must be their lexicographic order
+        """
+        blocks, offsets = bytearray(), list()
+        previous = None
+        for index, term in enumerate(terms):
+            term = term.encode()
+            if previous is not None and term <= previous:
+                raise ValueError("term ids must follow the lexicographic order of the terms")
+            prefix = 0
+            if index % block_size == 0:
+                offsets.append(len(blocks))
+            else:
+                while prefix < min(len(term), len(previous)) and term[prefix] == previous[prefix]:
+                    prefix += 1
+            blocks += _encode_varint(prefix) + _encode_varint(len(term) - prefix) + term[prefix:]
+            previous = term
+        length = 0 if previous is None else index + 1
+        blocks_start = _HEADER.size + _OFFSET.size * len(offsets)
+        make_dirs(file_path)
+        with open(file_path + ".tmp", 'wb') as dictionary_file:
+            dictionary_file.write(_HEADER.pack(_MAGIC, length, block_size))
+            for offset in offsets:
+                dictionary_file.write(_OFFSET.pack(blocks_start + offset))
+            dictionary_file.write(blocks)
+        replace(file_path + ".tmp", file_path)  # a dictionary is never read while being written
+
+    def __len__(self):
+        return self._length
+
+    def _block_terms(self, block):
+        """Yield the terms of a block, as bytes."""
+        offset = _OFFSET.unpack_from(self._data, _HEADER.size + _OFFSET.size * block)[0]
+        term = b""
+        for _ in range(min(self._block_size, self._length - block * self._block_size)):
+            prefix, offset = _decode_varint(self._data, offset)
+            size, offset = _decode_varint(self._data, offset)
+            term = term[:prefix] + self._data[offset:offset + size]
+            offset += size
+            yield term
+
+    def _first_term(self, block):
+        offset = _OFFSET.unpack_from(self._data, _HEADER.size + _OFFSET.size * block)[0] + 1  # skips the null prefix
+        size, offset = _decode_varint(self._data, offset)
+        return self._data[offset:offset + size]
+
+    def get(self, term, default=None):
+        term = term.encode()
+        low, high = 0, self._blocks_amount - 1  # the last block whose first term is not after term
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self._first_term(middle) <= term:
+                low = middle
+            else:
+                high = middle - 1
+        if self._blocks_amount > 0:
+            for index, block_term in enumerate(self._block_terms(low)):
+                if block_term == term:
+                    return low * self._block_size + index + 1
+                if block_term > term:
+                    break
+        return default
+
+    def get_term(self, term_id):
+        """Return the term of a term id: the scan of its block."""
+        if not 1 <= term_id <= self._length:
+            raise KeyError(term_id)
+        block, index = divmod(term_id - 1, self._block_size)
+        for block_index, term in enumerate(self._block_terms(block)):
+            if block_index == index:
+                return term.decode()
+
+    def __getitem__(self, term):
+        term_id = self.get(term)
+        if term_id is None:
+            raise KeyError(term)
+        return term_id
+
+    def __contains__(self, term):
+        return self.get(term) is not None
+
+    def __iter__(self):
+        """Iterate over the terms, ordered by term id."""
+        for block in range(self._blocks_amount):
+            for term in self._block_terms(block):
+                yield term.decode()
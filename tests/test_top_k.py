@@ -0,0 +1,67 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from collection import Collection
+from index_construction.main import build_index
+from index_construction.weights import WeightFactory
+from queries.vector_queries import VectorQueryParser
+
+_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_BM25 = [weighter.__name__ for weighter in WeightFactory.weightClasses].index("BM25")
+_QUERIES = ["w1", "w2", "w1 w2", "w30 w1", "w200 w1", "w3 w7 w50", "w100 w2 w1", "w500", "w50 w50 w4"]
+
+
+class TopKTest(unittest.TestCase):
+    """Top-k retrieval must return the best documents of an exhaustive evaluation, with the same scores."""
+
+    def setUp(self):
+        self._cwd = os.getcwd()
+        self._dir = tempfile.mkdtemp()
+        os.chdir(self._dir)
+        shutil.copy(os.path.join(_ROOT, "common_words"), "common_words")
+        rng = random.Random(0)
+        vocabulary = ["w%i" % rank for rank in range(1, 1001)]
+        frequencies = [1.0 / rank for rank in range(1, 1001)]
+        for doc in range(2000):
+            os.makedirs("topk-data/%i" % (doc % 4), exist_ok=True)
+            with open("topk-data/%i/doc%i" % (doc % 4, doc), 'w') as doc_file:
+                doc_file.write(" ".join(rng.choices(vocabulary, weights=frequencies, k=20)))
+
+    def tearDown(self):
+        os.chdir(self._cwd)
+        shutil.rmtree(self._dir)
+
+    def _check(self, weight_function_id):
+        collection = Collection("topk-data", verbose=False)
+        positions = build_index(collection, weight_function_id, verbose=False)
+        index_path = "indexes/%s.index" % collection.collection_path
+        exhaustive = VectorQueryParser(collection, index_path, positions, verbose=False)
+        for k in [1, 10, 100]:
+            top = VectorQueryParser(collection, index_path, positions, verbose=False, top_k=k)
+            for query in _QUERIES:
+                freqs = dict()
+                for term in exhaustive._clean_query(query):
+                    freqs[term] = freqs.get(term, 0) + 1
+                doc_ids, scores = exhaustive._rank(freqs)
+                order = np.argsort(-scores, kind='stable')[:k]
+                top_doc_ids, top_scores = top._rank(freqs)
+                self.assertEqual(top_scores.tolist(), scores[order].tolist(), (k, query))
+                # ties aside, the documents are the same
+                ties = set(doc_ids[scores >= scores[order[-1]]].tolist()) if len(order) > 0 else set()
+                self.assertTrue(set(top_doc_ids.tolist()) <= ties, (k, query))
+
+    def test_bm25(self):
+        """BM25 gives a negative weight to the terms found in more than half the documents, e.g. w1 and w2."""
+        self._check(_BM25)
+
+    def test_normalized_tf_idf(self):
+        self._check(1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,20 @@
 import struct
-from os.path import dirname, exists
-from os import makedirs
+from itertools import accumulate
+from os.path import dirname, getsize
+from os import makedirs, replace
+
+import numpy as np
+
+REFINED_POSTING_DTYPE = np.dtype([('doc_id', '=i4'), ('weight', '=f4')])  # the layout of a refined posting in memory
+POSITIONS_DTYPE = np.dtype('<i8')  # the layout of a positions file: one 8-byte little-endian offset per term id
+POSTING_CODEC_VERSION = 3
+POSTINGS_PER_CHUNK = 128  # the upper bounds of the weights of a refined posting list are given per chunk of postings
+INDEX_HEADER = b"TSE" + bytes([POSTING_CODEC_VERSION])  # the first bytes of any index file
+_VECTORIZED_CODEC_THRESHOLD = 128  # shorter posting lists are encoded and decoded in pure Python, faster than NumPy
 
 
 def make_dirs(filepath):
-    basedir = dirname(filepath)
-    if not exists(basedir):
-        makedirs(basedir)
+    makedirs(dirname(filepath), exist_ok=True)  # parser threads may create the same directory at once
 
 
 def load_map(map_path, key_type=str, value_type=str):
@@ -25,30 +33,325 @@ def save_map(m_map, file_path):
             map_file.write("%s : %s\n" % (key, m_map[key]))
 
 
+def save_vocabulary(terms, file_path):
+    with open(file_path, 'w') as vocabulary_file:
+        for term in terms:
+            vocabulary_file.write("%s\n" % term)
+
+
 def load_positions(positions_path):
-    result = list()
-    with open(positions_path) as positions_file:
-        for line in positions_file:
-            result.append(int(line))
-    return result
+    """Map a positions file in memory as a read-only int64 array: loading it is a file open, whatever its size."""
+    if getsize(positions_path) == 0:  # mmap cannot map an empty file
+        return np.empty(0, dtype=POSITIONS_DTYPE)
+    return np.memmap(positions_path, dtype=POSITIONS_DTYPE, mode='r')
 
 
 def save_positions(positions, file_path):
-    with open(file_path, 'w') as positions_file:
-        for position in positions:
-            positions_file.write("%i\n" % position)
+    with open(file_path + ".tmp", 'wb') as positions_file:
+        positions_file.write(np.asarray(positions, dtype=POSITIONS_DTYPE).tobytes())
+    replace(file_path + ".tmp", file_path)  # the previous file may still be mapped by a query parser
 
 
-def term_index_to_bin(term_index, refined=False):
-    bin_format = 'if' if refined else '2i'
-    result = struct.pack('i', term_index[0])
-    for posting in term_index[1]:
-        result += struct.pack(bin_format, *posting)
+def _varint_sizes(values):
+    """Return the amount of bytes of the varint of each value of an uint64 array."""
+    sizes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        sizes += values >= (1 << shift)
+    return sizes
+
+
+def _encode_varints(values):
+    """Encode non-negative integers with variable-byte coding: 7 bits per byte, high bit set on all the bytes of a value
+    but the last one. Long arrays are encoded without a Python loop."""
+    if len(values) < _VECTORIZED_CODEC_THRESHOLD:
+        if max(values, default=0) < 0x80:
+            return bytes(values)
+        result = bytearray()
+        for value in values:
+            value = int(value)
+            while value >= 0x80:
+                result.append(value & 0x7f | 0x80)
+                value >>= 7
+            result.append(value)
+        return bytes(result)
+    values = np.asarray(values, dtype=np.uint64)
+    sizes = _varint_sizes(values)
+    owners = np.repeat(np.arange(len(values)), sizes)
+    shifts = np.arange(len(owners)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    result = (values[owners] >> (7 * shifts).astype(np.uint64)) & 0x7f
+    result |= (shifts < sizes[owners] - 1).astype(np.uint64) << 7
+    return result.astype(np.uint8).tobytes()
+
+
+def _decode_varints(raw_bin):
+    """Decode a buffer of variable-byte coded integers into a list of int, or an int64 array for long buffers."""
+    if len(raw_bin) < _VECTORIZED_CODEC_THRESHOLD:
+        if max(raw_bin, default=0) < 0x80:
+            return list(raw_bin)
+        result, value, shift = list(), 0, 0
+        for byte in raw_bin:
+            value |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                result.append(value)
+                value, shift = 0, 0
+            else:
+                shift += 7
+        return result
+    data = np.frombuffer(raw_bin, dtype=np.uint8)
+    continued = data >= 0x80
+    if not continued.any():  # only 1-byte varints, e.g. the doc id gaps of a frequent term
+        return data.astype(np.int64)
+    ends = np.flatnonzero(~continued)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = np.arange(len(data)) - np.repeat(starts, ends - starts + 1)
+    return np.add.reduceat((data & 0x7f).astype(np.int64) << (7 * shifts), starts)
+
+
+def check_index_header(index_file):
+    """Raise a ValueError if an index file was not written with the current posting codec."""
+    header = index_file.read(len(INDEX_HEADER))
+    if header != INDEX_HEADER:
+        raise ValueError("%s was not written with version %i of the posting codec: build the index again"
+                         % (index_file.name, POSTING_CODEC_VERSION))
+
+
+def _encode_upper_bounds(doc_ids, gaps, weights):
+    """
+    Encode the upper bounds and the skip data of a refined posting list: its max weight, then the last doc id, the max
+    weight and the offset of the first doc id gap of each chunk of POSTINGS_PER_CHUNK postings, as 4-byte ints and
+    floats. The chunks are omitted if there is only one.
+    """
+    if not isinstance(weights, np.ndarray):
+        return struct.pack('f', max(weights, default=0.0))
+    result = struct.pack('f', weights.max())
+    if len(weights) > POSTINGS_PER_CHUNK:
+        starts = np.arange(0, len(weights), POSTINGS_PER_CHUNK)
+        last_doc_ids = np.asarray(doc_ids)[np.minimum(starts + POSTINGS_PER_CHUNK, len(weights)) - 1]
+        gap_offsets = np.concatenate(([0], np.cumsum(_varint_sizes(gaps.astype(np.uint64)))))[starts]
+        result += last_doc_ids.astype('=i4').tobytes() + np.maximum.reduceat(weights, starts).tobytes()
+        result += gap_offsets.astype('=i4').tobytes()
     return result
 
 
+def _upper_bounds_size(length):
+    chunks_amount = -(-length // POSTINGS_PER_CHUNK)
+    return 4 + (12 * chunks_amount if chunks_amount > 1 else 0)
+
+
+def _decode_length(raw_bin):
+    """Return the amount of postings of a binary posting list and the offset of the field that follows it."""
+    offset = 4
+    while raw_bin[offset] >= 0x80:
+        offset += 1
+    return _decode_varints(raw_bin[4:offset + 1])[0], offset + 1
+
+
+def term_index_to_bin(term_index, refined=False):
+    """
+    Encode a posting list with the posting codec.
+
+    The term id is followed by the amount of postings and the gaps between doc ids, as varints. Frequencies are then
+    varints too, whereas weights are 4-byte floats, and the amount of postings of a refined posting list is followed by
+    the upper bounds of its weights and its skip data (see _encode_upper_bounds). The doc ids of a posting list must be
+    increasing.
+    """
+    term_id, posting_list = term_index
+    if len(posting_list) < _VECTORIZED_CODEC_THRESHOLD:
+        if isinstance(posting_list, np.ndarray):
+            posting_list = posting_list.tolist()
+        varints, previous = [len(posting_list)], 0
+        for posting in posting_list:
+            varints.append(int(posting[0]) - previous)
+            previous = int(posting[0])
+        if refined:
+            weights = [float(posting[1]) for posting in posting_list]
+            return struct.pack('i', term_id) + _encode_varints(varints[:1]) + \
+                _encode_upper_bounds(None, None, weights) + _encode_varints(varints[1:]) + \
+                struct.pack('%if' % len(weights), *weights)
+        varints.extend([int(posting[1]) for posting in posting_list])
+        return struct.pack('i', term_id) + _encode_varints(varints)
+    if isinstance(posting_list, np.ndarray):  # a posting list with the REFINED_POSTING_DTYPE layout
+        doc_ids, values = posting_list['doc_id'], posting_list['weight']
+    else:
+        doc_ids, values = zip(*posting_list)
+    result = struct.pack('i', term_id) + _encode_varints([len(posting_list)])
+    gaps = np.diff(np.asarray(doc_ids, dtype=np.int64), prepend=0)
+    if refined:
+        weights = np.asarray(values, dtype='=f4')
+        result += _encode_upper_bounds(doc_ids, gaps, weights)
+    result += _encode_varints(gaps)
+    if refined:
+        return result + weights.tobytes()
+    return result + _encode_varints(values)
+
+
+def decode_posting_list(raw_bin, refined=False):
+    """Decode a binary posting list into (term_id, doc_ids, weights or frequencies), as NumPy arrays."""
+    term_id = struct.unpack_from('i', raw_bin)[0]
+    length, offset = _decode_length(raw_bin)
+    if refined:
+        values = np.frombuffer(raw_bin, dtype='=f4', offset=len(raw_bin) - 4 * length)
+        gaps = _decode_varints(raw_bin[offset + _upper_bounds_size(length):len(raw_bin) - 4 * length])
+    else:
+        varints = _decode_varints(raw_bin[offset:])
+        gaps, values = varints[:length], np.asarray(varints[length:], dtype=np.int64)
+    if isinstance(gaps, list):  # a short posting list, decoded in pure Python
+        return term_id, np.array(list(accumulate(gaps)), dtype=np.int64), values
+    return term_id, np.cumsum(gaps), values
+
+
+def decode_max_weight(raw_bin):
+    """Return the max weight of a binary refined posting list, without decoding its postings."""
+    return struct.unpack_from('f', raw_bin, _decode_length(raw_bin)[1])[0]
+
+
+def decode_posting_list_length(raw_bin):
+    """Return the amount of postings of a binary posting list, without decoding them."""
+    return _decode_length(raw_bin)[0]
+
+
+def decode_chunks(raw_bin):
+    """
+    Return the last doc id and the max weight of each chunk of POSTINGS_PER_CHUNK postings of a binary refined posting
+    list, as NumPy arrays. The postings are only decoded if the posting list has a single chunk.
+    """
+    length, offset = _decode_length(raw_bin)
+    chunks_amount = -(-length // POSTINGS_PER_CHUNK)
+    if chunks_amount > 1:
+        return (np.frombuffer(raw_bin, dtype='=i4', count=chunks_amount, offset=offset + 4).astype(np.int64),
+                np.frombuffer(raw_bin, dtype='=f4', count=chunks_amount, offset=offset + 4 + 4 * chunks_amount))
+    last_doc_ids = decode_posting_list(raw_bin, refined=True)[1][-1:]
+    return last_doc_ids, np.frombuffer(raw_bin, dtype='=f4', count=1, offset=offset)
+
+
+def decode_chunk(raw_bin, chunk):
+    """
+    Decode a chunk of POSTINGS_PER_CHUNK postings of a binary refined posting list into (doc_ids, weights), as NumPy
+    arrays. The skip data give the offset of its first doc id gap, and the previous chunk ends with the doc id it is
+    relative to: the other chunks are skipped.
+    """
+    length, offset = _decode_length(raw_bin)
+    chunks_amount = -(-length // POSTINGS_PER_CHUNK)
+    if chunks_amount == 1:
+        return decode_posting_list(raw_bin, refined=True)[1:]
+    last_doc_ids = np.frombuffer(raw_bin, dtype='=i4', count=chunks_amount, offset=offset + 4)
+    gap_offsets = np.frombuffer(raw_bin, dtype='=i4', count=chunks_amount, offset=offset + 4 + 8 * chunks_amount)
+    gaps_start = offset + _upper_bounds_size(length)
+    weights_start = len(raw_bin) - 4 * length
+    end = weights_start if chunk == chunks_amount - 1 else gaps_start + int(gap_offsets[chunk + 1])
+    gaps = _decode_varints(raw_bin[gaps_start + int(gap_offsets[chunk]):end])
+    previous_doc_id = 0 if chunk == 0 else int(last_doc_ids[chunk - 1])
+    if isinstance(gaps, list):
+        doc_ids = np.array(list(accumulate(gaps, initial=previous_doc_id))[1:], dtype=np.int64)
+    else:
+        doc_ids = previous_doc_id + np.cumsum(gaps)
+    weights_start += 4 * POSTINGS_PER_CHUNK * chunk
+    return doc_ids, np.frombuffer(raw_bin, dtype='=f4', count=len(doc_ids), offset=weights_start)
+
+
+def encode_positions(positions, tfs=None):
+    """
+    Encode the positions of a term in one or more documents as the varints of the gaps between positions, the first
+    position of each document being relative to 0.
+    :param positions: the increasing positions in each document, concatenated
+    :param tfs: the amount of positions in each document, None for a single document
+    """
+    if tfs is None and len(positions) < _VECTORIZED_CODEC_THRESHOLD:
+        return _encode_varints([position - previous for previous, position in zip([0] + positions, positions)])
+    positions = np.asarray(positions, dtype=np.int64)
+    gaps = np.diff(positions, prepend=0)
+    if tfs is not None and len(tfs) > 0:
+        starts = np.cumsum(tfs) - tfs
+        gaps[starts] = positions[starts]
+    return _encode_varints(gaps if len(gaps) >= _VECTORIZED_CODEC_THRESHOLD else gaps.tolist())
+
+
+def encode_term_vectors(term_ids, offsets):
+    """
+    Encode the increasing term ids of consecutive vectors as the varints of the gaps between term ids, the first term id
+    of each vector being relative to 0.
+    :param offsets: the index of the first term id of each vector in term_ids, plus the end, from 0
+    :return: (the encoded term ids, the byte offset of each vector plus the end, as an int64 NumPy array)
+    """
+    term_ids = np.asarray(term_ids, dtype=np.int64)
+    gaps = np.diff(term_ids, prepend=0)
+    starts = offsets[:-1][offsets[:-1] < offsets[1:]]  # the first term id of each non-empty vector
+    gaps[starts] = term_ids[starts]
+    byte_offsets = np.concatenate(([0], np.cumsum(_varint_sizes(gaps.astype(np.uint64)))))[offsets]
+    return _encode_varints(gaps if len(gaps) >= _VECTORIZED_CODEC_THRESHOLD else gaps.tolist()), byte_offsets
+
+
+def decode_term_vectors(raw_bin, offsets):
+    """Decode the term ids of consecutive vectors (see encode_term_vectors) into an int64 NumPy array."""
+    sums = np.cumsum(np.asarray(_decode_varints(raw_bin), dtype=np.int64))
+    return sums - np.repeat(np.concatenate(([0], sums))[offsets[:-1]], np.diff(offsets))
+
+
+def positions_to_bin(tfs, gaps_bin):
+    """
+    Encode the positions of a term in the documents of its posting list.
+
+    The amount of postings and the size of their frequencies are followed by the offset of the first position gap of
+    each chunk of POSTINGS_PER_CHUNK postings, as 4-byte ints (omitted if there is only one chunk), the frequencies as
+    varints and the position gaps (see encode_positions).
+    """
+    tfs = np.asarray(tfs, dtype=np.int64)
+    tfs_bin = _encode_varints(tfs if len(tfs) >= _VECTORIZED_CODEC_THRESHOLD else tfs.tolist())
+    result = _encode_varints([len(tfs), len(tfs_bin)])
+    if len(tfs) > POSTINGS_PER_CHUNK:
+        gaps = np.asarray(_decode_varints(gaps_bin), dtype=np.uint64)
+        value_starts = np.concatenate(([0], np.cumsum(tfs)))[0:len(tfs):POSTINGS_PER_CHUNK]
+        result += np.concatenate(([0], np.cumsum(_varint_sizes(gaps))))[value_starts].astype('=i4').tobytes()
+    return result + tfs_bin + gaps_bin
+
+
+def decode_positions(raw_bin, ranks):
+    """
+    Decode the positions of a term in some documents of its posting list, only decoding the chunks that hold them.
+    :param ranks: the increasing ranks of the documents in the posting list
+    :return: (index of the document in ranks, position) of each position, as NumPy arrays
+    """
+    ranks = np.asarray(ranks, dtype=np.int64)
+    varint_ends = np.flatnonzero(np.frombuffer(raw_bin[:20], dtype=np.uint8) < 0x80)
+    length, tfs_size = _decode_varints(raw_bin[:varint_ends[1] + 1])
+    offset = int(varint_ends[1]) + 1
+    chunks_amount = -(-length // POSTINGS_PER_CHUNK)
+    gap_offsets = np.zeros(1, dtype=np.int64)
+    if chunks_amount > 1:
+        gap_offsets = np.frombuffer(raw_bin, dtype='=i4', count=chunks_amount, offset=offset).astype(np.int64)
+        offset += 4 * chunks_amount
+    tfs = np.asarray(_decode_varints(raw_bin[offset:offset + tfs_size]), dtype=np.int64)
+    gaps_start = offset + tfs_size
+    value_starts = np.concatenate(([0], np.cumsum(tfs)))
+    chunks = np.unique(ranks // POSTINGS_PER_CHUNK)
+    gap_ends = np.append(gap_offsets[1:], len(raw_bin) - gaps_start)
+    gaps = np.asarray(_decode_varints(b"".join([raw_bin[gaps_start + gap_offsets[chunk]:gaps_start + gap_ends[chunk]]
+                                                for chunk in chunks.tolist()])), dtype=np.int64)
+    chunk_starts = value_starts[chunks * POSTINGS_PER_CHUNK]  # the first gap of each decoded chunk in the term
+    chunk_sizes = value_starts[np.minimum((chunks + 1) * POSTINGS_PER_CHUNK, length)] - chunk_starts
+    chunk_bases = np.cumsum(chunk_sizes) - chunk_sizes  # ... and in the decoded gaps
+    chunk_indexes = np.searchsorted(chunks, ranks // POSTINGS_PER_CHUNK)
+    starts = chunk_bases[chunk_indexes] + value_starts[ranks] - chunk_starts[chunk_indexes]
+    lengths = tfs[ranks]
+    owners = np.repeat(np.arange(len(ranks)), lengths)
+    first_indexes = np.cumsum(lengths) - lengths
+    gaps = gaps[np.repeat(starts - first_indexes, lengths) + np.arange(len(owners))]
+    positions = np.cumsum(gaps)
+    return owners, positions - np.repeat(positions[first_indexes] - gaps[first_indexes], lengths)
+
+
 def bin_to_term_index(raw_bin, refined=False):
-    bin_format = 'if' if refined else '2i'
+    """Decode a binary posting list into (term_id, [(doc_id, weight or frequency), ...])."""
+    if len(raw_bin) >= _VECTORIZED_CODEC_THRESHOLD:
+        term_id, doc_ids, values = decode_posting_list(raw_bin, refined)
+        return term_id, list(zip(doc_ids.tolist(), values.tolist()))
     term_id = struct.unpack_from('i', raw_bin)[0]
-    occurrences = list(struct.iter_unpack(bin_format, raw_bin[4:]))
-    return term_id, occurrences
+    if refined:  # a short posting list, hence less than 128 postings: its size is a 1-byte varint
+        length = raw_bin[4]
+        weights_offset = len(raw_bin) - 4 * length
+        weights = struct.unpack_from('%if' % length, raw_bin, weights_offset)
+        gaps = _decode_varints(raw_bin[5 + _upper_bounds_size(length):weights_offset])
+        return term_id, list(zip(accumulate(gaps), weights))
+    varints = _decode_varints(raw_bin[4:])
+    length = varints[0]
+    return term_id, list(zip(accumulate(varints[1:length + 1]), varints[length + 1:]))